@@ -0,0 +1,106 @@
+# 静的ファイルを起動時にメモリへ読み込み、圧縮済みの版と ETag を用意しておく
+# リクエストごとにディスクを読まない (変更を反映するにはサーバーを再起動する)
+from fastapi import Request
+from fastapi.responses import Response
+import gzip
+import hashlib
+import os
+
+# brotli は任意の依存。なければ gzip だけ用意する
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CONTENT_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+}
+# 指紋付き URL は中身が変われば URL も変わるので、ずっとキャッシュさせる
+IMMUTABLE = "public, max-age=31536000, immutable"
+# 通常の URL は毎回 ETag で確認させる
+REVALIDATE = "no-cache"
+# これより小さいものは圧縮しない
+MIN_COMPRESS_SIZE = 256
+# 圧縮形式の優先順
+ENCODINGS = ("br", "gzip")
+
+
+class Asset:
+    __slots__ = ("content_type", "variants", "fingerprint")
+
+    def __init__(self, content_type: str, body: bytes):
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.content_type = content_type
+        self.fingerprint = digest[:12]
+        # content-encoding -> (本文, ETag)。表現ごとに別の強い ETag にする
+        self.variants = {"identity": (body, f'"{digest}"')}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(body, 9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants["gzip"] = (compressed, f'"{digest}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    self.variants["br"] = (compressed, f'"{digest}-br"')
+
+    def negotiate(self, accept_encoding: str) -> str:
+        # Accept-Encoding の q 値を見て、用意してある中で一番優先度の高いものを選ぶ
+        accepted = {}
+        for item in accept_encoding.split(","):
+            name, _, params = item.strip().partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+        wildcard = accepted.get("*", 0.0)
+        for encoding in ENCODINGS:
+            if encoding in self.variants and accepted.get(encoding, wildcard) > 0:
+                return encoding
+        return "identity"
+
+
+class AssetStore:
+    def __init__(self, directory: str, index: str, files: list[str], fingerprint: bool = False):
+        # URL のパス -> (Asset, Cache-Control)
+        self.routes: dict[str, tuple[Asset, str]] = {}
+        with open(os.path.join(directory, index), "rb") as f:
+            html = f.read()
+
+        for name in files:
+            with open(os.path.join(directory, name), "rb") as f:
+                asset = Asset(CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream"), f.read())
+            self.routes["/" + name] = (asset, REVALIDATE)
+            if fingerprint:
+                # index.html から参照している URL を指紋付きのものに書き換える
+                stem, ext = os.path.splitext(name)
+                url = f"/static/{stem}.{asset.fingerprint}{ext}"
+                self.routes[url] = (asset, IMMUTABLE)
+                html = html.replace(f'"{name}"'.encode(), f'"{url}"'.encode())
+
+        self.routes["/"] = (Asset(CONTENT_TYPES[".html"], html), REVALIDATE)
+
+    def response(self, request: Request, path: str) -> Response:
+        entry = self.routes.get(path)
+        if entry is None:
+            return Response(status_code=404)
+        asset, cache_control = entry
+        encoding = asset.negotiate(request.headers.get("accept-encoding", ""))
+        body, etag = asset.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            # 比べるのは今回選んだ表現の ETag だけ (別の表現の本文を持っているクライアントに 304 を返さない)
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or etag in tags:
+                return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type=asset.content_type, headers=headers)
@@ -0,0 +1,334 @@
+# 負荷試験: 本物のプロトコルを話すボットを大量に接続して、処理能力と遅延を測る
+# 結果は JSON で出力する (コミット間の比較用)
+#
+#   python bench.py --rooms 500 --players 4 --duration 30 --out result.json
+#   python bench.py --url ws://127.0.0.1:8000 ...   (起動済みのサーバーを測る)
+#   python bench.py --inprocess ...                 (同じプロセス内で uvicorn を動かす)
+#
+# ボットはサーバーが配った手札のピースを、空いているマスにだけ置く
+# 遅延は batch_update を送ってから、同じ部屋の各プレイヤーがその中継を受け取るまでの時間
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from bitboard import mask_to_updates
+from shapes import SHAPE_PLACEMENTS, UNIQUE_SHAPES
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# game_state の手札 (形の配列) -> 形の番号
+SHAPE_INDEX = {repr(shape): i for i, shape in enumerate(UNIQUE_SHAPES)}
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.turns = 0
+        self.games = 0
+        self.rejected = 0
+        # (部屋, 置いたマスク) -> 送信時刻
+        self.pending: dict[tuple, float] = {}
+        self.recording = False
+
+
+def percentile(values: list[float], q: float):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Bot:
+    def __init__(self, room_id: str, index: int, stats: Stats, args):
+        self.room_id = room_id
+        self.index = index
+        self.stats = stats
+        self.args = args
+        self.rng = random.Random(f"{room_id}:{index}:{args.seed}")
+        self.my_id = 0
+        self.host_id = 0
+        self.current_turn = 0
+        self.is_playing = False
+        self.is_clearing = False
+        self.starting = False
+        self.board = 0
+        self.hand = []
+        self.ws = None
+        self.turn_task: asyncio.Task = None
+
+    async def send(self, message: dict):
+        self.stats.sent += 1
+        await self.ws.send(json.dumps(message))
+
+    async def run(self, url: str, stop: asyncio.Event):
+        import websockets
+
+        self.ws = await websockets.connect(f"{url}/ws/{self.room_id}?nickname=bot{self.index}", max_size=None)
+        try:
+            receiver = asyncio.create_task(self.receive())
+            await stop.wait()
+            receiver.cancel()
+        finally:
+            if self.turn_task is not None:
+                self.turn_task.cancel()
+            await self.ws.close()
+
+    async def receive(self):
+        stats = self.stats
+        async for text in self.ws:
+            now = time.perf_counter()
+            stats.received += 1
+            data = json.loads(text)
+            kind = data.get("type")
+            if kind == "batch_update":
+                placed = 0
+                for item in data["updates"]:
+                    bit = 1 << (item["row"] * 8 + item["col"])
+                    if item["value"]:
+                        placed |= bit
+                        self.board |= bit
+                    else:
+                        self.board &= ~bit
+                sent_at = stats.pending.get((self.room_id, placed))
+                if sent_at is not None and stats.recording:
+                    stats.latencies.append(now - sent_at)
+            elif kind == "move_rejected":
+                stats.rejected += 1
+                self.board = sum(1 << (r * 8 + c) for r, row in enumerate(data["board"])
+                                 for c, v in enumerate(row) if v)
+                self.set_hand(data["hand"])
+            elif kind == "welcome":
+                self.my_id = data["your_id"]
+                self.host_id = data["host_id"]
+            elif kind == "game_state":
+                if "host_id" in data:
+                    self.host_id = data["host_id"]
+                if "is_playing" in data:
+                    self.is_playing = data["is_playing"]
+                if "is_clearing" in data:
+                    self.is_clearing = data["is_clearing"]
+                if "board" in data:
+                    self.board = sum(1 << (r * 8 + c) for r, row in enumerate(data["board"])
+                                     for c, v in enumerate(row) if v)
+                if "hand" in data:
+                    self.set_hand(data["hand"])
+                if "current_turn" in data:
+                    self.current_turn = data["current_turn"]
+                    stats.turns += 1
+                await self.on_state()
+            elif kind == "game_start":
+                self.is_playing = True
+            elif kind == "game_over":
+                self.is_playing = False
+                stats.games += 1
+                await self.on_state()
+            elif kind == "error":
+                stats.errors += 1
+
+    def set_hand(self, hand: list):
+        self.hand = [None if shape is None else SHAPE_INDEX[repr(shape)] for shape in hand]
+
+    async def on_state(self):
+        if not self.is_playing:
+            # ホストだけが (1 ゲームにつき 1 回) 開始する
+            if self.my_id == self.host_id and not self.starting:
+                self.starting = True
+                await self.send({"type": "start_game", "max_rounds": self.args.rounds})
+            return
+        self.starting = False
+        if self.current_turn == self.my_id:
+            if self.turn_task is None or self.turn_task.done():
+                self.turn_task = asyncio.create_task(self.take_turn())
+        elif self.rng.random() < self.args.skip_rate:
+            await self.send({"type": "vote_skip"})
+
+    async def take_turn(self):
+        stats = self.stats
+        for _ in range(self.args.moves):
+            await asyncio.sleep(self.args.think)
+            # ライン消去の確定待ちの間は置けない
+            while self.is_clearing and self.current_turn == self.my_id:
+                await asyncio.sleep(0.01)
+            if self.current_turn != self.my_id:
+                return
+            # 手札のうち今の盤面に置けるものを 1 つ選ぶ (使い切るか置けなくなればサーバーが手番を終える)
+            mask = 0
+            slots = [i for i, shape in enumerate(self.hand) if shape is not None]
+            for slot in self.rng.sample(slots, len(slots)):
+                legal = [m for m in SHAPE_PLACEMENTS[self.hand[slot]] if not m & self.board]
+                if legal:
+                    mask = self.rng.choice(legal)
+                    self.hand[slot] = None
+                    break
+            if not mask:
+                return
+            stats.pending[(self.room_id, mask)] = time.perf_counter()
+            await self.send({"type": "batch_update", "updates": mask_to_updates(mask, 1)})
+        await asyncio.sleep(self.args.think)
+        # --moves で打ち切った時だけ、残りの手札を捨ててパスする
+        if self.current_turn == self.my_id and any(shape is not None for shape in self.hand):
+            await self.send({"type": "pass_turn"})
+
+
+def read_cpu_seconds(pid: int):
+    # /proc/<pid>/stat の utime + stime (Linux のみ)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+
+async def wait_for_server(host: str, port: int, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def bench(args) -> dict:
+    stats = Stats()
+    server = None
+    server_task = None
+    env = dict(os.environ)
+    if not args.keep_storage:
+        # ディスクへの書き出しは測定から外す
+        env.update(SNAPSHOT_DIR="", JOURNAL_DIR="", LEADERBOARD_DB="")
+
+    url = args.url
+    if url is None:
+        url = f"ws://127.0.0.1:{args.port}"
+        if args.inprocess:
+            import uvicorn
+            os.environ.update({k: v for k, v in env.items() if k in ("SNAPSHOT_DIR", "JOURNAL_DIR", "LEADERBOARD_DB")})
+            sys.path.insert(0, BASE_DIR)
+            import main
+            config = uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+            inprocess_server = uvicorn.Server(config)
+            server_task = asyncio.create_task(inprocess_server.serve())
+        else:
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                 "--port", str(args.port), "--log-level", "warning"],
+                cwd=BASE_DIR, env=env)
+        await wait_for_server("127.0.0.1", args.port)
+
+    stop = asyncio.Event()
+    bots = [Bot(f"bench-{r}", i, stats, args) for r in range(args.rooms) for i in range(args.players)]
+    tasks = []
+    connect_limit = asyncio.Semaphore(args.connect_concurrency)
+    connected = 0
+
+    async def start(bot: Bot):
+        nonlocal connected
+        async with connect_limit:
+            task = asyncio.create_task(bot.run(url, stop))
+            tasks.append(task)
+            while bot.my_id == 0 and not task.done():
+                await asyncio.sleep(0.01)
+            if not task.done():
+                connected += 1
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(start(bot) for bot in bots))
+        connect_sec = time.perf_counter() - started
+
+        if args.warmup > 0:
+            await asyncio.sleep(args.warmup)
+        stats.recording = True
+        sent0, received0 = stats.sent, stats.received
+        cpu0 = read_cpu_seconds(server.pid) if server else time.process_time()
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - started
+        cpu1 = read_cpu_seconds(server.pid) if server else time.process_time()
+        stats.recording = False
+        sent, received = stats.sent - sent0, stats.received - received0
+
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if server_task is not None:
+            inprocess_server.should_exit = True
+            await server_task
+
+    latencies = sorted(stats.latencies)
+    cpu = cpu1 - cpu0 if cpu0 is not None and cpu1 is not None else None
+    cores = cpu / elapsed if cpu else None
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "config": {"rooms": args.rooms, "players": args.players, "duration": args.duration,
+                   "moves": args.moves, "think": args.think, "skip_rate": args.skip_rate,
+                   "inprocess": args.inprocess, "url": args.url},
+        "connections": connected,
+        "connect_sec": round(connect_sec, 3),
+        "elapsed_sec": round(elapsed, 3),
+        "messages_sent": sent,
+        "messages_received": received,
+        "sent_per_sec": round(sent / elapsed, 1),
+        "received_per_sec": round(received / elapsed, 1),
+        "turns": stats.turns,
+        "games": stats.games,
+        "errors": stats.errors,
+        "rejected_moves": stats.rejected,
+        "latency_ms": {
+            "count": len(latencies),
+            "p50": ms(percentile(latencies, 0.5)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        # サーバーの CPU 時間 (--inprocess ではボットの分も含む)
+        "server_cpu_sec": round(cpu, 3) if cpu is not None else None,
+        "cores_used": round(cores, 3) if cores else None,
+        "rooms_per_core": round(args.rooms / cores, 1) if cores else None,
+        "connections_per_core": round(connected / cores, 1) if cores else None,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None, help="起動済みのサーバー (例: ws://127.0.0.1:8000)")
+    parser.add_argument("--port", type=int, default=8300)
+    parser.add_argument("--inprocess", action="store_true")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--moves", type=int, default=3, help="1 手番あたりの batch_update の上限 (手札は 3 枚)")
+    parser.add_argument("--think", type=float, default=0.05, help="操作の間隔 (秒)")
+    parser.add_argument("--skip-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--keep-storage", action="store_true", help="スナップショット・操作ログ・ランキングを無効にしない")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    result = asyncio.run(bench(args))
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,83 @@
+# 8x8 の盤面を 64bit 整数 1 つで扱うビットボード
+# マス (row, col) はビット row * 8 + col に対応する
+
+BOARD_SIZE = 8
+FULL_BOARD = (1 << 64) - 1
+
+COL_MASKS = tuple(0x0101010101010101 << c for c in range(BOARD_SIZE))
+
+# 各行の先頭ビット / 1 行目のビット (行・列の判定結果を集約する位置)
+_ROW_HEADS = 0x0101010101010101
+_COL_HEADS = 0xFF
+
+
+def full_lines(bits: int) -> tuple[int, int]:
+    # 行: 右方向に 1,2,4 ビットずつ AND を畳み込むと、各行の先頭ビットに「行が全部埋まっているか」が残る
+    x = bits & (bits >> 1)
+    x &= x >> 2
+    x &= x >> 4
+    # 列: 同じことを 8,16,32 ビット (= 1,2,4 行) 単位で行う
+    y = bits & (bits >> 8)
+    y &= y >> 16
+    y &= y >> 32
+    return x & _ROW_HEADS, y & _COL_HEADS
+
+
+def line_mask(rows: int, cols: int) -> int:
+    # 先頭ビットを行・列全体に展開する (バイト/列が重ならないので桁上がりは起きない)
+    return (rows * 0xFF) | (cols * _ROW_HEADS)
+
+
+def mask_to_updates(mask: int, value: int) -> list[dict]:
+    updates = []
+    while mask:
+        low = mask & -mask
+        i = low.bit_length() - 1
+        updates.append({"row": i >> 3, "col": i & 7, "value": value})
+        mask ^= low
+    return updates
+
+
+def updates_to_masks(updates: list) -> tuple[int, int]:
+    # [{"row", "col", "value"}, ...] を (1 にするマス, 0 にするマス) のマスクにする
+    set_mask = 0
+    unset_mask = 0
+    for item in updates:
+        r, c, v = item["row"], item["col"], item["value"]
+        if 0 <= r < BOARD_SIZE and 0 <= c < BOARD_SIZE:
+            bit = 1 << (r * BOARD_SIZE + c)
+            if v == 1:
+                set_mask |= bit
+                unset_mask &= ~bit
+            else:
+                unset_mask |= bit
+                set_mask &= ~bit
+    return set_mask, unset_mask
+
+
+class Bitboard:
+    __slots__ = ("bits",)
+
+    def __init__(self, bits: int = 0):
+        self.bits = bits
+
+    def apply_masks(self, set_mask: int, unset_mask: int = 0) -> None:
+        self.bits = (self.bits | set_mask) & ~unset_mask
+
+    def find_lines(self) -> tuple[int, int]:
+        # (消すマスのマスク, 消えるライン数)
+        rows, cols = full_lines(self.bits)
+        if not (rows or cols):
+            return 0, 0
+        return line_mask(rows, cols), rows.bit_count() + cols.bit_count()
+
+    def clear(self, mask: int) -> None:
+        self.bits &= ~mask
+
+    def reset(self) -> None:
+        self.bits = 0
+
+    def to_rows(self) -> list[list[int]]:
+        # welcome / init 用のリスト表現
+        bits = self.bits
+        return [[(bits >> (r * BOARD_SIZE + c)) & 1 for c in range(BOARD_SIZE)] for r in range(BOARD_SIZE)]
@@ -0,0 +1,108 @@
+# bot の思考エンジン。盤面 (64bit) と手札 (形の番号) から、1 手番分の置き方の並びを探す
+# 手札の置く順番と位置を深さ優先で探し、各段では評価の高い候補だけを残す (ビーム幅)。
+# ビーム幅を広げながら時間いっぱいまで探し直し、最後に探し終えた結果を使う
+# プロセスプールから呼ばれるので、引数と戻り値は int と list と str だけにする
+import time
+
+from bitboard import COL_MASKS, FULL_BOARD, full_lines, line_mask
+from rules import rules_for
+from shapes import SHAPE_PLACEMENTS
+
+# 横方向にずらした時に反対側の端へ回り込まないようにするマスク
+_NOT_COL0 = FULL_BOARD & ~COL_MASKS[0]
+_NOT_COL7 = FULL_BOARD & ~COL_MASKS[7]
+# 横に 3 / 5 マス並べられる左端の位置
+_START3 = sum(COL_MASKS[c] for c in range(6))
+_START5 = sum(COL_MASKS[c] for c in range(4))
+
+# 評価の重み (selfplay.py で調整する)
+W_POINTS = 1.0
+W_EMPTY = 0.5
+W_ISOLATED = -6.0
+W_ROUGH = -0.6
+W_FIT3 = 12.0
+W_FIT5 = 8.0
+# 置けずに残った手札 1 枚あたり
+W_STUCK = -40.0
+
+BEAM_WIDTHS = (3, 6, 12, 24, 48)
+
+
+def place(board: int, mask: int) -> tuple[int, int]:
+    # 置いて揃ったラインを消した盤面と、消えたライン数
+    board |= mask
+    rows, cols = full_lines(board)
+    if not (rows or cols):
+        return board, 0
+    return board & ~line_mask(rows, cols), rows.bit_count() + cols.bit_count()
+
+
+def evaluate(board: int) -> float:
+    # 盤面の良さ: 空きが多く、孤立した空きマスや凸凹が少なく、大きな形がまだ置けるほど良い
+    empty = ~board & FULL_BOARD
+    neighbours = ((empty << 1) & _NOT_COL0) | ((empty >> 1) & _NOT_COL7) | (empty << 8) | (empty >> 8)
+    isolated = empty & ~neighbours
+    rough = ((board ^ (board >> 1)) & _NOT_COL7).bit_count() + ((board ^ (board >> 8)) & (FULL_BOARD >> 8)).bit_count()
+    h3 = empty & (empty >> 1) & (empty >> 2) & _START3
+    fit3 = h3 & (h3 >> 8) & (h3 >> 16)
+    h5 = empty & (empty >> 1) & (empty >> 2) & (empty >> 3) & (empty >> 4) & _START5
+    v5 = empty & (empty >> 8) & (empty >> 16) & (empty >> 24) & (empty >> 32)
+    return (W_EMPTY * empty.bit_count() + W_ISOLATED * isolated.bit_count() + W_ROUGH * rough
+            + (W_FIT3 if fit3 else 0.0) + (W_FIT5 if h5 or v5 else 0.0))
+
+
+class _Search:
+    __slots__ = ("rules", "width", "deadline", "nodes")
+
+    def __init__(self, rules, width: int, deadline: float):
+        self.rules = rules
+        self.width = width
+        self.deadline = deadline
+        self.nodes = 0
+
+    def run(self, board: int, hand: tuple, combo: int) -> tuple[float, list]:
+        # (評価値, 置き方の並び)。時間切れなら TimeoutError
+        self.nodes += 1
+        if self.nodes & 63 == 0 and time.perf_counter() > self.deadline:
+            raise TimeoutError
+        children = []
+        seen = set()
+        for i, shape in enumerate(hand):
+            if shape in seen:
+                continue
+            seen.add(shape)
+            rest = hand[:i] + hand[i + 1:]
+            for mask in SHAPE_PLACEMENTS[shape]:
+                if mask & board:
+                    continue
+                after, lines = place(board, mask)
+                points, next_combo = self.rules.score(lines, combo) if lines else (0, combo)
+                children.append((W_POINTS * points + evaluate(after), points, mask, after, rest, next_combo))
+        if not children:
+            return evaluate(board) + W_STUCK * len(hand), []
+        children.sort(key=lambda child: child[0], reverse=True)
+        best = None
+        for quick, points, mask, after, rest, next_combo in children[:self.width]:
+            if rest:
+                value, moves = self.run(after, rest, next_combo)
+                value += W_POINTS * points
+            else:
+                value, moves = quick, []
+            if best is None or value > best[0]:
+                best = (value, [mask] + moves)
+        return best
+
+
+def plan(board: int, hand: list, combo: int = 0, rules_name: str = "", budget: float = 0.05) -> list[int]:
+    # 手札 (使用済みは None) を置く順番の置き方のマスク。1 枚も置けなければ空
+    pieces = tuple(shape for shape in hand if shape is not None)
+    deadline = time.perf_counter() + budget
+    rules = rules_for(rules_name)
+    # 一番狭いビーム幅は時間に関係なく最後まで探す (必ず何か答えを返す)
+    _, best = _Search(rules, BEAM_WIDTHS[0], float("inf")).run(board, pieces, combo)
+    for width in BEAM_WIDTHS[1:]:
+        try:
+            _, best = _Search(rules, width, deadline).run(board, pieces, combo)
+        except TimeoutError:
+            break
+    return best
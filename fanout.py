@@ -0,0 +1,165 @@
+# 接続ごとの送信キューと書き込みタスク
+# broadcast はキューに積むだけで即座に戻り、遅いクライアントは他の接続を待たせない
+from fastapi import WebSocket
+from collections import deque
+import asyncio
+import json
+import os
+import time
+
+from metrics import Counters
+import wire
+
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", "64"))
+# drop: 溢れたら古いものから捨てる / coalesce: game_state を最新 1 件にまとめる / evict: 溢れたら切断
+SLOW_CLIENT_POLICY = os.environ.get("SLOW_CLIENT_POLICY", "coalesce")
+# 1 通の送信、またはキュー先頭の滞留がこの秒数を超えたら切断する
+SEND_DEADLINE = float(os.environ.get("SEND_DEADLINE", "5"))
+
+COALESCE_TYPES = {"game_state", "spectate"}
+
+# JSON エンコーダ (起動時に選択). orjson は任意の依存
+JSON_ENCODER = os.environ.get("JSON_ENCODER", "json")
+
+if JSON_ENCODER == "orjson":
+    import orjson
+
+    def encode_json(message: dict) -> tuple[str, int]:
+        data = orjson.dumps(message)
+        return data.decode(), len(data)
+else:
+    def encode_json(message: dict) -> tuple[str, int]:
+        text = json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+        return text, len(text) if text.isascii() else len(text.encode())
+
+# 全接続分の送信の集計 (/metrics)
+send_stats = Counters("frames", "bytes", "failures", "dropped", "evicted")
+
+
+class Frame:
+    # 一度だけエンコードした送信フレーム。同じ Frame を全接続に配る
+    # full: 差分フレームをまとめる時に代わりに送る完全なフレームを返す関数
+    __slots__ = ("type", "text", "size", "full", "message", "_binary")
+
+    def __init__(self, message: dict, full=None):
+        self.type = message.get("type")
+        # size: UTF-8 でのバイト数 (送信量の集計用)
+        self.text, self.size = encode_json(message)
+        self.full = full
+        self.message = message
+        self._binary = None
+
+    def binary(self):
+        # バイナリ形式 (wire.py)。バイナリの接続に初めて送る時に 1 回だけエンコードする。対象外なら None
+        if self._binary is None:
+            self._binary = wire.encode(self.message) or b""
+        return self._binary or None
+
+
+_CLOSE = object()
+
+
+class ConnectionSender:
+    __slots__ = ("websocket", "binary", "queue", "closed", "dropped", "_wakeup", "_task")
+
+    def __init__(self, websocket: WebSocket, binary: bool = False):
+        self.websocket = websocket
+        # バイナリ形式を選んだ接続か (対象外のフレームは JSON で送る)
+        self.binary = binary
+        # (enqueue 時刻, メッセージ)
+        self.queue: deque = deque()
+        self.closed = False
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def push(self, frame: Frame) -> bool:
+        if self.closed:
+            return False
+        queue = self.queue
+        now = time.monotonic()
+
+        if queue and now - queue[0][0] > SEND_DEADLINE:
+            self.evict()
+            return False
+
+        if SLOW_CLIENT_POLICY == "coalesce" and frame.type in COALESCE_TYPES:
+            # 未送信の同種メッセージは最新のもので置き換える
+            for i, (_, queued) in enumerate(queue):
+                if queued is not _CLOSE and queued.type == frame.type:
+                    del queue[i]
+                    self.dropped += 1
+                    send_stats.inc("dropped")
+                    # 差分は前の差分を前提にしているので、捨てた場合は完全なフレームで置き換える
+                    if frame.full is not None:
+                        frame = frame.full()
+                    break
+
+        if len(queue) >= SEND_QUEUE_SIZE:
+            if SLOW_CLIENT_POLICY == "drop":
+                queue.popleft()
+                self.dropped += 1
+                send_stats.inc("dropped")
+            else:
+                self.evict()
+                return False
+
+        queue.append((now, frame))
+        self._wakeup.set()
+        return True
+
+    def close(self):
+        # キューに残っている分を送ってから閉じる
+        if self.closed:
+            return
+        self.queue.append((time.monotonic(), _CLOSE))
+        self.closed = True
+        self._wakeup.set()
+
+    def evict(self):
+        # 送信が詰まった接続: 残りを捨てて即座に閉じる。受信側は WebSocketDisconnect で後始末される
+        send_stats.inc("evicted")
+        if self._task.done():
+            self.closed = True
+            return
+        self.queue.clear()
+        self.close()
+
+    def cancel(self):
+        self.closed = True
+        self.queue.clear()
+        if not self._task.done():
+            self._task.cancel()
+
+    async def _run(self):
+        websocket = self.websocket
+        queue = self.queue
+        try:
+            while True:
+                while not queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, frame = queue.popleft()
+                if frame is _CLOSE:
+                    await asyncio.wait_for(websocket.close(), SEND_DEADLINE)
+                    return
+                data = frame.binary() if self.binary else None
+                if data is not None:
+                    await asyncio.wait_for(websocket.send_bytes(data), SEND_DEADLINE)
+                    size = len(data)
+                else:
+                    await asyncio.wait_for(websocket.send_text(frame.text), SEND_DEADLINE)
+                    size = frame.size
+                send_stats.inc("frames")
+                send_stats.inc("bytes", size)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 送信失敗・タイムアウトした接続は以後使わない
+            send_stats.inc("failures")
+            self.closed = True
+            queue.clear()
+            try:
+                await asyncio.wait_for(websocket.close(), SEND_DEADLINE)
+            except Exception:
+                pass
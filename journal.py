@@ -0,0 +1,93 @@
+# 部屋ごとの追記専用の操作ログ (固定長バイナリ)
+# 追記はメモリ上の bytearray へのコピーだけ。ファイルへの書き出しは専用スレッドでまとめて行う
+from concurrent.futures import ThreadPoolExecutor, Future
+import hashlib
+import os
+import struct
+import time
+
+# 時刻, 種別, プレイヤー ID, 引数, 64bit の値 (盤面マスクなど)
+RECORD = struct.Struct("<dBBHQ")
+
+# 入力 (アクターが受け取ったコマンド)。リプレイではこれを同じロジックに流し直す
+EV_OPEN = 1
+EV_JOIN = 2
+EV_LEAVE = 3
+EV_START = 4
+EV_PLACE = 5
+# 6 は以前の版の EV_UNSET (置いたマスを戻す操作)。今は記録しないが、古いログと番号が重ならないよう使わない
+EV_END_TURN = 7
+EV_PASS_TURN = 8
+EV_VOTE_SKIP = 9
+EV_VOTE_RESET = 10
+EV_VETO = 11
+EV_KICK = 12
+EV_COMMIT_CLEAR = 13
+EV_TIMEOUT = 14
+EV_FORGET = 15
+EV_ADD_BOT = 16
+# 次の EV_JOIN がセッションのトークンでの再接続 (値は取り出す再接続データのキーのハッシュ)
+EV_RESUME = 17
+
+# 結果 (ゲームロジックが決めたこと)。リプレイで再計算したものと突き合わせる
+EV_CLEAR = 32
+EV_ROTATE = 33
+EV_GAME_OVER = 34
+EV_RESET = 35
+EV_RESTORE = 36
+EV_DEAL = 37
+EV_AUTO_PASS = 38
+
+OUTCOME_EVENTS = {EV_CLEAR, EV_ROTATE, EV_GAME_OVER, EV_RESET, EV_RESTORE, EV_DEAL, EV_AUTO_PASS}
+
+EVENT_NAMES = {value: name[3:].lower() for name, value in globals().items() if name.startswith("EV_")}
+
+_U64 = (1 << 64) - 1
+
+
+def name_key(name: str) -> int:
+    # 名前は固定長に入らないので 64bit のハッシュで記録する (同じ名前かどうかはリプレイでも再現できる)
+    if not name:
+        return 0
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little") or 1
+
+
+class Journal:
+    __slots__ = ("buffer",)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def append(self, kind: int, player_id: int = 0, arg: int = 0, value: int = 0):
+        self.buffer += RECORD.pack(time.time(), kind, player_id & 0xFF, arg & 0xFFFF, value & _U64)
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def iter_records(data: bytes):
+    for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+        yield RECORD.unpack_from(data, offset)
+
+
+class JournalStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    def path_for(self, room_id: str) -> str:
+        digest = hashlib.sha1(room_id.encode()).hexdigest()
+        return os.path.join(self.directory, digest + ".log")
+
+    def write(self, room_id: str, data: bytes) -> Future:
+        return self.executor.submit(self._append, self.path_for(room_id), data)
+
+    def flush(self):
+        self.executor.submit(lambda: None).result()
+
+    def _append(self, path: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(data)
@@ -0,0 +1,110 @@
+# 全部屋・全期間のランキング (SQLite)。得点の付け方が違うのでルールの種類ごとに分ける
+# 結果はイベントループ上でリストに積むだけ。書き込みは専用スレッドでまとめて 1 トランザクションにする
+# 上位はスレッドが書き込みの後に読み直してメモリに置き、HTTP からはそれを返す (ディスクは読まない)
+from concurrent.futures import ThreadPoolExecutor, Future
+import os
+import sqlite3
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    variant TEXT NOT NULL,
+    name TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    players INTEGER NOT NULL,
+    room_id TEXT NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leaderboard (
+    variant TEXT NOT NULL,
+    name TEXT NOT NULL,
+    games INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    best_score INTEGER NOT NULL,
+    total_score INTEGER NOT NULL,
+    last_played REAL NOT NULL,
+    PRIMARY KEY (variant, name)
+);
+CREATE INDEX IF NOT EXISTS leaderboard_best ON leaderboard (variant, best_score DESC, wins DESC);
+"""
+
+_UPSERT = """
+INSERT INTO leaderboard (variant, name, games, wins, best_score, total_score, last_played)
+VALUES (?, ?, 1, ?, ?, ?, ?)
+ON CONFLICT (variant, name) DO UPDATE SET
+    games = games + 1,
+    wins = wins + excluded.wins,
+    best_score = max(best_score, excluded.best_score),
+    total_score = total_score + excluded.total_score,
+    last_played = excluded.last_played
+"""
+
+_TOP = """
+SELECT name, best_score, wins, games, total_score FROM leaderboard WHERE variant = ?
+ORDER BY best_score DESC, wins DESC, name LIMIT ?
+"""
+
+
+class Leaderboard:
+    def __init__(self, path: str, variants, size: int = 100):
+        self.path = path
+        self.variants = tuple(variants)
+        self.size = size
+        # ループ側で溜めている (variant, name, score, rank, players, room_id, finished_at)
+        self.pending: list[tuple] = []
+        # ルールの種類ごとの上位 size 件 (スレッドが丸ごと差し替える。読む側はそのまま返すだけ)
+        self.top: dict[str, list[dict]] = {variant: [] for variant in self.variants}
+        self.written = 0
+        self._conn: sqlite3.Connection = None
+        # 接続はこのスレッドだけで使う
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leaderboard")
+
+    def record(self, room_id: str, variant: str, ranking: list[dict], skip_ids=()):
+        # game_over の順位を積む (ゲストなど名前で区別できない人は skip_ids で除く)
+        now = time.time()
+        players = len(ranking)
+        for rank, player in enumerate(ranking, 1):
+            if player["id"] not in skip_ids:
+                self.pending.append((variant, player["name"], player["score"], rank, players, room_id, now))
+
+    def flush(self) -> Future:
+        # 溜まった結果を専用スレッドに渡す (空でも上位を読み直す: 他のプロセスの書き込みを拾うため)
+        batch, self.pending = self.pending, []
+        return self.executor.submit(self._write, batch)
+
+    def wait(self):
+        self.executor.submit(lambda: None).result()
+
+    def top_entries(self, variant: str, limit: int) -> list[dict]:
+        return self.top.get(variant, [])[:max(0, min(limit, self.size))]
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # シャーディング時は複数のプロセスが同じファイルに書くので WAL と待ち時間を設定する
+            self._conn = sqlite3.connect(self.path, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def _write(self, batch: list[tuple]):
+        conn = self._connect()
+        if batch:
+            with conn:
+                conn.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                conn.executemany(_UPSERT, [(variant, name, int(rank == 1), score, score, finished_at)
+                                           for variant, name, score, rank, _, _, finished_at in batch])
+            self.written += len(batch)
+        self._refresh()
+
+    def _refresh(self):
+        conn = self._connect()
+        top = {}
+        for variant in self.variants:
+            rows = conn.execute(_TOP, (variant, self.size)).fetchall()
+            top[variant] = [{"name": name, "best_score": best, "wins": wins, "games": games, "total_score": total}
+                            for name, best, wins, games, total in rows]
+        self.top = top
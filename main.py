@@ -1,33 +1,267 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import PlainTextResponse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from collections import deque
 import json
 import asyncio
+import heapq
+import itertools
+import random
+import secrets
 import time
 import os
 import traceback
 
-app = FastAPI()
+from assets import AssetStore
+from bitboard import Bitboard, mask_to_updates
+import engine
+from fanout import ConnectionSender, Frame, send_stats
+from leaderboard import Leaderboard
+from metrics import COUNT_BUCKETS, Counters, Histogram, render_histogram, render_value
+from shard import shard_for
+from snapshot import SnapshotStore, encode_room
+import journal as ev
+import wire
+from journal import Journal, JournalStore, name_key
+from players import PlayerTable
+from rules import DEFAULT_RULES, RULES, RULES_BY_ID, Rules, rules_for
+from shapes import PLACEMENTS, UNIQUE_SHAPES, PlacementIndex, deal_hand, pack_hand, placement_mask
+from timerwheel import Timer, TimerWheel
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global bot_pool
+    if BOT_WORKERS > 0:
+        bot_pool = ProcessPoolExecutor(BOT_WORKERS)
+    tasks = [asyncio.create_task(timer_wheel.run())]
+    if snapshot_store is not None:
+        tasks.append(asyncio.create_task(snapshot_loop()))
+    if journal_store is not None:
+        tasks.append(asyncio.create_task(journal_loop()))
+    if leaderboard is not None:
+        # 起動時に上位を読み込む (ファイルもここで初めて作る)
+        leaderboard.flush()
+        tasks.append(asyncio.create_task(leaderboard_loop()))
+    tasks.append(asyncio.create_task(lifecycle_loop()))
+    yield
+    for task in tasks:
+        task.cancel()
+    if bot_pool is not None:
+        bot_pool.shutdown(wait=False, cancel_futures=True)
+        bot_pool = None
+    if journal_store is not None:
+        flush_journals()
+        await asyncio.to_thread(journal_store.flush)
+    if leaderboard is not None:
+        leaderboard.flush()
+        await asyncio.to_thread(leaderboard.wait)
+    if snapshot_store is not None:
+        # 停止時は全部屋を保存してから終わる
+        save_snapshots(only_dirty=False)
+        await asyncio.to_thread(snapshot_store.flush)
+
+app = FastAPI(lifespan=lifespan)
+
+# game_state をまとめる間隔 (秒)。0 ならイベントループの次の周回でまとめて送る
+STATE_TICK = float(os.environ.get("STATE_TICK", "0"))
+# ライン消去の演出時間 (秒)
+CLEAR_DELAY = 0.3
+# 観戦者に送る 1 秒あたりのフレーム数と、1 部屋あたりの観戦者の上限
+SPECTATOR_FPS = float(os.environ.get("SPECTATOR_FPS", "4"))
+MAX_SPECTATORS_PER_ROOM = int(os.environ.get("MAX_SPECTATORS_PER_ROOM", "500"))
+# 再接続したクライアントに送り直すため、部屋ごとに残しておく番号付きのイベント (盤面の差分など) の数
+EVENT_RING_SIZE = int(os.environ.get("EVENT_RING_SIZE", "256"))
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# 部屋のスナップショット。SNAPSHOT_DIR を空にすると無効
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(BASE_DIR, "snapshots"))
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "5"))
+snapshot_store = SnapshotStore(SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+
+# 操作ログ (replay.py で再生できる)。JOURNAL_DIR を空にすると無効
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", os.path.join(BASE_DIR, "journal"))
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", "1"))
+journal_store = JournalStore(JOURNAL_DIR) if JOURNAL_DIR else None
+
+# 全期間のランキング (SQLite)。LEADERBOARD_DB を空にすると無効
+LEADERBOARD_DB = os.environ.get("LEADERBOARD_DB", os.path.join(BASE_DIR, "leaderboard.sqlite3"))
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", "100"))
+LEADERBOARD_FLUSH_INTERVAL = float(os.environ.get("LEADERBOARD_FLUSH_INTERVAL", "2"))
+leaderboard = Leaderboard(LEADERBOARD_DB, RULES, LEADERBOARD_SIZE) if LEADERBOARD_DB else None
+
+# bot の思考は別プロセスで行う (プロセス数 0 なら bot は席を取るだけで考えない)
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "2"))
+# 1 手番の思考時間と、bot が 1 枚置くごとの間隔 (秒)
+BOT_BUDGET = float(os.environ.get("BOT_BUDGET", "0.05"))
+BOT_MOVE_DELAY = float(os.environ.get("BOT_MOVE_DELAY", "0.4"))
+bot_pool: ProcessPoolExecutor = None
+
+# サーバー側の手番の締め切り (秒)。0 なら無効。全部屋で 1 つのタイマーホイールを使う
+TURN_TIMEOUT = float(os.environ.get("TURN_TIMEOUT", "90"))
+timer_wheel = TimerWheel(tick=0.1)
+
+# 部屋と再接続データの寿命 (秒)。0 なら無効
+DISCONNECT_TTL = float(os.environ.get("DISCONNECT_TTL", "600"))
+ROOM_IDLE_TTL = float(os.environ.get("ROOM_IDLE_TTL", "3600"))
+# 1 部屋あたりの再接続データの上限 (古いものから消す)
+DISCONNECT_MAX = int(os.environ.get("DISCONNECT_MAX", "50"))
+# サーバー全体の上限。超えたら使われていない順に追い出す (0 なら無制限)
+MAX_ROOMS = int(os.environ.get("MAX_ROOMS", "0"))
+DISCONNECT_BUDGET = int(os.environ.get("DISCONNECT_BUDGET", "100000"))
+LIFECYCLE_INTERVAL = float(os.environ.get("LIFECYCLE_INTERVAL", "30"))
+# ホットパスの計測 (/metrics)。種類ごとのヒストグラムは最初に全部作っておく
+HANDLED_TYPES = ("join", "leave", "watch", "unwatch", "commit_clear", "turn_timeout", "sweep", "evict",
+                 "start_game", "kick_player", "batch_update", "end_turn", "pass_turn",
+                 "vote_reset", "vote_skip", "sync_state", "veto_skip", "add_bot", "bot_plan", "bot_step",
+                 "other")
+handle_seconds = {kind: Histogram() for kind in HANDLED_TYPES}
+queue_seconds = Histogram()
+broadcast_seconds = Histogram()
+rejected_moves = Counters("turn", "shape", "occupied", "hand")
+# セッションのトークンで再接続した数 (events: 抜けていたイベントだけ送った / snapshot: 盤面ごと送り直した)
+resumes = Counters("events", "snapshot")
+
+# 追い出した数
+evictions = {"disconnected_ttl": 0, "disconnected_lru": 0, "disconnected_budget": 0,
+             "rooms_idle": 0, "rooms_budget": 0}
+
+# 静的ファイルは起動時にメモリへ読み込む。ASSET_FINGERPRINT=1 で指紋付き URL (/static/...) を使う
+ASSET_FINGERPRINT = os.environ.get("ASSET_FINGERPRINT", "0") == "1"
+assets = AssetStore(BASE_DIR, 'index.html', ['style.css', 'script.js'], fingerprint=ASSET_FINGERPRINT)
+
 @app.api_route("/", methods=["GET", "HEAD"])
-async def get(request: Request = None):
-    return FileResponse(os.path.join(BASE_DIR, 'index.html'))
+async def get(request: Request):
+    return assets.response(request, "/")
 
 @app.get("/style.css")
-async def get_css():
-    return FileResponse(os.path.join(BASE_DIR, 'style.css'))
+async def get_css(request: Request):
+    return assets.response(request, "/style.css")
 
 @app.get("/script.js")
-async def get_js():
-    return FileResponse(os.path.join(BASE_DIR, 'script.js'))
+async def get_js(request: Request):
+    return assets.response(request, "/script.js")
+
+@app.get("/static/{filename}")
+async def get_static(request: Request, filename: str):
+    return assets.response(request, "/static/" + filename)
+
+@app.get("/metrics")
+async def get_metrics():
+    lines = []
+    render_histogram(lines, "blockblast_handle_seconds", "Time spent handling a command in the room actor",
+                     handle_seconds, "type")
+    render_histogram(lines, "blockblast_queue_seconds", "Time a command waited in the room inbox",
+                     {None: queue_seconds})
+    render_histogram(lines, "blockblast_broadcast_seconds", "Time spent encoding and queueing a broadcast",
+                     {None: broadcast_seconds})
+    render_value(lines, "blockblast_sent_frames_total", "counter", "Frames written to websockets",
+                 {None: send_stats.values["frames"]})
+    render_value(lines, "blockblast_sent_bytes_total", "counter", "Bytes written to websockets",
+                 {None: send_stats.values["bytes"]})
+    render_value(lines, "blockblast_send_failures_total", "counter", "Sends that failed or timed out",
+                 {None: send_stats.values["failures"]})
+    render_value(lines, "blockblast_send_dropped_total", "counter", "Frames dropped or coalesced for slow clients",
+                 {None: send_stats.values["dropped"]})
+    render_value(lines, "blockblast_send_evicted_total", "counter", "Connections closed for falling behind",
+                 {None: send_stats.values["evicted"]})
+    render_value(lines, "blockblast_rejected_moves_total", "counter", "batch_update submissions that were rejected",
+                 rejected_moves.values, "reason")
+    render_value(lines, "blockblast_evictions_total", "counter", "Rooms and reconnect records evicted",
+                 evictions, "reason")
+    render_value(lines, "blockblast_resumes_total", "counter", "Reconnects that presented a valid session token",
+                 resumes.values, "result")
+
+    players = Histogram(COUNT_BUCKETS)
+    for room in rooms.values():
+        players.observe(len(room.players))
+    render_value(lines, "blockblast_rooms", "gauge", "Live rooms", {None: len(rooms)})
+    render_value(lines, "blockblast_connections", "gauge", "Live websocket connections", {None: int(players.sum)})
+    render_value(lines, "blockblast_spectators", "gauge", "Live spectator connections",
+                 {None: sum(len(room.spectators) for room in rooms.values())})
+    render_value(lines, "blockblast_disconnected_records", "gauge", "Reconnect records held in memory",
+                 {None: sum(len(room.disconnected_data) for room in rooms.values())})
+    render_value(lines, "blockblast_timers", "gauge", "Timers pending on the timer wheel", {None: len(timer_wheel)})
+    render_histogram(lines, "blockblast_room_players", "Players per live room", {None: players})
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/leaderboard")
+async def get_leaderboard(limit: int = 20, variant: str = DEFAULT_RULES.name):
+    # メモリ上の上位だけを返す (ディスクは読まない)
+    if leaderboard is None:
+        return {"variant": variant, "entries": []}
+    return {"variant": variant, "entries": leaderboard.top_entries(variant, limit)}
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "rooms": len(rooms),
+        "connections": sum(len(room.players) for room in rooms.values()),
+        "spectators": sum(len(room.spectators) for room in rooms.values()),
+        "disconnected": sum(len(room.disconnected_data) for room in rooms.values()),
+        "evictions": evictions,
+    }
+
+def wants_binary(websocket) -> bool:
+    # 接続時に ?proto=bin を付けたクライアントには、対応するフレームをバイナリ形式 (wire.py) で送る
+    params = getattr(websocket, "query_params", None)
+    return params is not None and params.get("proto") == "bin"
+
+def session_params(websocket) -> tuple[str, int]:
+    # 再接続: ?session=<前回の welcome のトークン>&last_seq=<最後に受け取ったイベントの eseq>
+    params = getattr(websocket, "query_params", None)
+    if params is None or not params.get("session"):
+        return None, None
+    try:
+        last_seq = int(params.get("last_seq", ""))
+    except ValueError:
+        last_seq = None
+    return params.get("session"), last_seq
+
+class BotSocket:
+    # bot の席の接続の代わり。送信キューは作らない (send_to は何もしない)
+    __slots__ = ()
+
+class Command:
+    # 部屋のアクターに送るコマンド。kind: join / message / leave / watch / unwatch / commit_clear / turn_timeout /
+    # bot_plan / bot_step / sweep / evict
+    __slots__ = ("kind", "websocket", "payload", "future", "queued_at")
+
+    def __init__(self, kind: str, websocket: WebSocket = None, payload=None, future: asyncio.Future = None):
+        self.kind = kind
+        self.websocket = websocket
+        self.payload = payload
+        self.future = future
+        self.queued_at = time.perf_counter()
 
 class GameRoom:
-    def __init__(self):
-        self.active_connections: dict[WebSocket, int] = {}
-        self.board = [[0] * 8 for _ in range(8)]
-        self.scores: dict[int, int] = {}
-        self.names: dict[int, str] = {}
+    def __init__(self, room_id: str, seed: int = None, rules: Rules = None):
+        self.room_id = room_id
+        # 得点・名前・ゲーム終了のルール (部屋を作る時に決める)
+        self.rules = rules or DEFAULT_RULES
+        # 今の手番で消したライン数 (コンボ点のルールで使う)
+        self.turn_combo: int = 0
+        # 接続・名前・スコア・ゲストか・投票はプレイヤー表にまとめる
+        self.players = PlayerTable(MAX_PLAYERS_PER_ROOM)
+        self.senders: dict[WebSocket, ConnectionSender] = {}
+        # 観戦者は人数の上限に数えず、読み取り専用。プレイヤーへの送信とは別に、
+        # 部屋ごとに 1 つのフレームを SPECTATOR_FPS に間引いて全員に配る
+        self.spectators: dict[WebSocket, ConnectionSender] = {}
+        self._spectator_handle: asyncio.TimerHandle = None
+        self._spectator_frame: Frame = None
+        self.board = Bitboard()
+        # 消去待ちを除いた盤面で置ける置き方と、手番のプレイヤーの手札 (形の番号、使ったら None)
+        self.placements = PlacementIndex()
+        self.hand: list = []
+        # 手札を配る乱数。シードは操作ログに残し、リプレイで同じ手札を配れるようにする
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        # bot の席の数と、思考中・配置中の手。bot_generation で古い思考結果を見分ける
+        self.bot_count: int = 0
+        self.bot_generation: int = 0
+        self._bot_plan: list[int] = []
+        self._bot_handle: asyncio.TimerHandle = None
         
         self.current_turn: int = 0
         self.total_turns_taken: int = 0
@@ -37,332 +271,944 @@ class GameRoom:
         self.is_clearing: bool = False
 
         self.turn_start_time: float = 0
-        self.skip_votes: set[int] = set()
-        self.reset_votes: set[int] = set()
         
         self.disconnected_data: dict[str, dict] = {}
-        # ゲスト(名前なし)かどうかを記録するセット
-        self.guest_ids: set[int] = set()
+        # 名前を自動で付けた・付け直したプレイヤーのビット (全期間のランキングに記録しない)
+        self.unranked: int = 0
+        # 再接続のトークン。接続中のプレイヤー ID -> トークンと、抜けた人のトークン -> disconnected_data のキー
+        # ゲストは名前で区別できないので「名前#番号」のキーで残し、トークンでだけ取り出せる
+        self.session_tokens: dict[int, str] = {}
+        self.sessions: dict[str, str] = {}
+        self.guest_leaves: int = 0
+        # 全員に送ったイベントの番号 (eseq) と、直近 EVENT_RING_SIZE 件のフレーム (再接続で送り直す)
+        self.event_seq: int = 0
+        self.events: deque[Frame] = deque(maxlen=EVENT_RING_SIZE)
+
+        # game_state の版番号と、最後に送った状態 (差分計算用)
+        self.state_seq: int = 0
+        self.last_state: dict = {}
+        self._snapshot: tuple[int, Frame] = None
+        # 状態変更はここに溜めて、tick の終わりに 1 フレームにまとめて送る
+        self._flush_handle: asyncio.Handle = None
+        self._pending_joins: list[WebSocket] = []
+        # 演出待ちのライン消去
+        self._clear_handle: asyncio.TimerHandle = None
+        self._clear_mask: int = 0
+
+        # 状態を変更するのはアクターのタスクだけ。接続側はコマンドを積むだけ
+        self.inbox: asyncio.Queue[Command] = asyncio.Queue()
+        self.closed: bool = False
+        # 前回のスナップショット以降に変更があったか / サーバー停止で全員切断されたか
+        self.snapshot_dirty: bool = False
+        self.suspended: bool = False
+        # 最後にプレイヤーが操作した時刻 (放置された部屋の追い出し用)
+        self.last_active: float = time.time()
+
+        self.journal = Journal()
+        self.journal.append(ev.EV_OPEN, 0, self.rules.id, self.seed)
+
+        # 手番の締め切り。turn_generation で古いタイマーからのコマンドを見分ける
+        self._turn_timer: Timer = None
+        self._turn_key: tuple = None
+        self.turn_generation: int = 0
+        self._actor = asyncio.get_running_loop().create_task(self._run())
+
+    def broadcast(self, message: dict):
+        # JSON へのエンコードは 1 回だけ。各接続の送信キューには同じフレームを積む
+        # 番号を付けてリングにも残す (再接続したクライアントには抜けていた分だけを送り直す)
+        started = time.perf_counter()
+        self.event_seq += 1
+        message["eseq"] = self.event_seq
+        frame = Frame(message)
+        self.events.append(frame)
+        for sender in list(self.senders.values()):
+            sender.push(frame)
+        self.mark_spectators()
+        broadcast_seconds.observe(time.perf_counter() - started)
+
+    def send_to(self, websocket: WebSocket, message: dict):
+        self.send_to_frame(websocket, Frame(message))
+
+    def send_to_frame(self, websocket: WebSocket, frame: Frame):
+        sender = self.senders.get(websocket)
+        if sender:
+            sender.push(frame)
+
+    def build_state(self) -> dict:
+        ranking = self.players.ranking()
+
+        player_count = len(self.players)
+        current_round = 1
+        if player_count > 0:
+            current_round = (self.total_turns_taken // player_count) + 1
+
+        return {
+            "count": player_count,
+            "ranking": ranking,
+            "current_turn": self.current_turn,
+            "turn_start_time": self.turn_start_time,
+            "skip_votes": self.players.vote_ids(self.players.skip_votes),
+            "reset_votes": self.players.vote_ids(self.players.reset_votes),
+            "host_id": self.host_id,
+            "is_playing": self.is_playing,
+            "round_info": f"{current_round}/{self.MAX_ROUNDS}",
+            "is_clearing": self.is_clearing,
+            "is_final": (current_round == self.MAX_ROUNDS),
+            "hand": self.hand_shapes()
+        }
+
+    def hand_shapes(self) -> list:
+        return [None if shape is None else UNIQUE_SHAPES[shape] for shape in self.hand]
+
+    def sync_placements(self):
+        # 消去待ちのマスは消えたものとして扱う (確定するまで誰も置けないので結果は変わらない)
+        self.placements.update(self.board.bits & ~self._clear_mask)
+
+    def deal(self):
+        # 手番のプレイヤーに、今の盤面で置ける形から手札を配る
+        if self.players.has(self.current_turn):
+            self.hand = deal_hand(self.rng, self.placements)
+        else:
+            self.hand = []
+        self.journal.append(ev.EV_DEAL, self.current_turn, 0, pack_hand(self.hand))
+        self.think()
+
+    def is_bot(self, player_id: int) -> bool:
+        return isinstance(self.players.socket_of(player_id), BotSocket)
+
+    def think(self):
+        # 手番が bot なら別プロセスで手を探す。結果はコマンドとして受信箱に戻ってくる
+        # bot が動くのはゲーム中だけ (ゲームの前後に置くと次のゲームの盤面が埋まる)
+        self.bot_generation += 1
+        self._bot_plan = []
+        if self._bot_handle is not None:
+            self._bot_handle.cancel()
+            self._bot_handle = None
+        if bot_pool is None or not self.is_playing or not self.hand or not self.is_bot(self.current_turn):
+            return
+        generation = self.bot_generation
+        future = asyncio.get_running_loop().run_in_executor(
+            bot_pool, engine.plan, self.placements.board, self.hand, self.turn_combo, self.rules.name, BOT_BUDGET)
+        future.add_done_callback(lambda f: self.submit(Command("bot_plan", payload=(generation, f))))
+
+    def bot_plan(self, generation: int, future: asyncio.Future):
+        if generation != self.bot_generation or self.closed:
+            return
+        if future.cancelled() or future.exception() is not None:
+            self._bot_plan = []
+        else:
+            self._bot_plan = future.result()
+        self.bot_step(generation)
 
-    async def broadcast(self, message: dict):
-        for connection in list(self.active_connections.keys()):
+    def bot_step(self, generation: int):
+        # 探した手を 1 枚ずつ置く (他のプレイヤーにも見えるよう間を空ける)。置けるものがなければパスする
+        self._bot_handle = None
+        if (generation != self.bot_generation or self.closed or not self.is_playing
+                or not self.is_bot(self.current_turn)):
+            return
+        bot_id = self.current_turn
+        websocket = self.players.socket_of(bot_id)
+        if self.is_clearing:
+            pass
+        elif self._bot_plan:
+            mask = self._bot_plan.pop(0)
+            self.handle_message(websocket, bot_id, {"type": "batch_update", "updates": mask_to_updates(mask, 1)})
+        else:
+            self.handle_message(websocket, bot_id, {"type": "pass_turn"})
+        if generation == self.bot_generation:
+            # まだ同じ手番が続いている (消去待ち、または次の 1 枚がある)
+            self._bot_handle = asyncio.get_running_loop().call_later(
+                BOT_MOVE_DELAY, self.submit, Command("bot_step", payload=generation))
+
+    def snapshot_frame(self) -> Frame:
+        # 現在の seq の完全なスナップショット (seq ごとに 1 回だけエンコード)
+        if self._snapshot is None or self._snapshot[0] != self.state_seq:
+            message = {"type": "game_state", "seq": self.state_seq, "full": True}
+            message.update(self.last_state)
+            self._snapshot = (self.state_seq, Frame(message))
+        return self._snapshot[1]
+
+    def mark_dirty(self, joined: WebSocket = None):
+        if joined is not None:
+            self._pending_joins.append(joined)
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if STATE_TICK > 0:
+                self._flush_handle = loop.call_later(STATE_TICK, self.flush_state)
+            else:
+                self._flush_handle = loop.call_soon(self.flush_state)
+
+    def flush_state(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        joined, self._pending_joins = self._pending_joins, []
+        self.broadcast_room_state(joined)
+
+    def broadcast_room_state(self, joined: list[WebSocket] = ()):
+        # 前回から変わったフィールドだけを seq 付きで送る。joined には完全なスナップショットを送る
+        state = self.build_state()
+        last_state = self.last_state
+        changed = {k: v for k, v in state.items() if last_state.get(k) != v}
+        if changed:
+            self.state_seq += 1
+            self.last_state = state
+            message = {"type": "game_state", "seq": self.state_seq}
+            message.update(changed)
+            frame = Frame(message, full=self.snapshot_frame)
+            for ws, sender in list(self.senders.items()):
+                if ws not in joined:
+                    sender.push(frame)
+            self.mark_spectators()
+        for ws in joined:
+            self.send_to_frame(ws, self.snapshot_frame())
+
+    def mark_spectators(self):
+        # 次の観戦フレームを予約する。予約済みなら何もしない (間の変更は 1 フレームにまとまる)
+        self._spectator_frame = None
+        if self.spectators and self._spectator_handle is None and not self.closed:
+            self._spectator_handle = asyncio.get_running_loop().call_later(
+                1 / SPECTATOR_FPS if SPECTATOR_FPS > 0 else 0, self.flush_spectators)
+
+    def spectator_frame(self) -> Frame:
+        # 盤面と状態の完全なスナップショット (変更があるまで全観戦者で使い回す)
+        if self._spectator_frame is None:
+            message = {"type": "spectate", "board": self.board.to_rows()}
+            message.update(self.build_state())
+            self._spectator_frame = Frame(message)
+        return self._spectator_frame
+
+    def flush_spectators(self):
+        self._spectator_handle = None
+        if not self.spectators:
+            return
+        frame = self.spectator_frame()
+        for sender in list(self.spectators.values()):
+            sender.push(frame)
+
+    def handle_watch(self, websocket: WebSocket):
+        # 観戦できなければエラーメッセージを、できれば None を返す
+        if len(self.spectators) >= MAX_SPECTATORS_PER_ROOM:
+            return "観戦者が満員です"
+        sender = self.spectators[websocket] = ConnectionSender(websocket, wants_binary(websocket))
+        sender.push(self.spectator_frame())
+        return None
+
+    def handle_unwatch(self, websocket: WebSocket):
+        sender = self.spectators.pop(websocket, None)
+        if sender:
+            sender.cancel()
+
+    def schedule_clear(self, mask: int):
+        self.is_clearing = True
+        self._clear_mask |= mask
+        if self._clear_handle is None:
+            self._clear_handle = asyncio.get_running_loop().call_later(
+                CLEAR_DELAY, self.submit, Command("commit_clear"))
+        self.mark_dirty()
+
+    def commit_clear(self):
+        # タイマーから 1 回だけ呼ばれ、消去と差分の送信を確定する
+        if self._clear_handle is None:
+            return
+        self._clear_handle = None
+        mask, self._clear_mask = self._clear_mask, 0
+        self.board.clear(mask)
+        self.broadcast({"type": "batch_update", "updates": mask_to_updates(mask, 0)})
+        self.is_clearing = False
+        self.mark_dirty()
+
+    def cancel_clear(self):
+        if self._clear_handle is not None:
+            self._clear_handle.cancel()
+            self._clear_handle = None
+        self._clear_mask = 0
+        self.is_clearing = False
+
+    def close(self):
+        # 部屋を破棄する時に保留中のタイマーを止める
+        self.closed = True
+        self.cancel_clear()
+        if self._turn_timer is not None:
+            self._turn_timer.cancel()
+            self._turn_timer = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._spectator_handle is not None:
+            self._spectator_handle.cancel()
+            self._spectator_handle = None
+        if self._bot_handle is not None:
+            self._bot_handle.cancel()
+            self._bot_handle = None
+        for sender in self.spectators.values():
+            sender.close()
+        if rooms.get(self.room_id) is self:
+            del rooms[self.room_id]
+        if journal_store is not None and self.journal.buffer:
+            journal_store.write(self.room_id, self.journal.take())
+        if snapshot_store is not None:
+            if self.suspended:
+                # 再起動のための切断: 再接続で復元できるよう最後の状態を残す
+                snapshot_store.save(self.room_id, encode_room(self))
+            else:
+                snapshot_store.delete(self.room_id)
+
+    def restore(self, data: dict):
+        # スナップショットの復元。プレイヤーは全員「切断中」として戻り、名前で再接続すると復元される
+        self.board.bits = data["board"]
+        self.MAX_ROUNDS = data["max_rounds"]
+        self.total_turns_taken = data["total_turns_taken"]
+        self.is_playing = data["is_playing"]
+        self.rules = RULES_BY_ID.get(data.get("variant", self.rules.id), self.rules)
+        self.sync_placements()
+        now = time.time()
+        for name, player in data["players"].items():
+            self.disconnected_data[name] = {**player, 'left_at': now}
+        self.journal.append(ev.EV_RESTORE, self.rules.id, self.total_turns_taken, self.board.bits)
+
+    def submit(self, command: Command):
+        # タイマー用のコマンドは仕掛けた時に作るので、待ち時間は受信箱に入れた時から測る
+        command.queued_at = time.perf_counter()
+        self.inbox.put_nowait(command)
+
+    async def _run(self):
+        # 溜まっているコマンドをまとめて処理し、状態の送信はバッチごとに 1 回にする
+        inbox = self.inbox
+        if snapshot_store is not None:
             try:
-                await connection.send_json(message)
-            except:
-                pass
+                data = await asyncio.wrap_future(snapshot_store.load(self.room_id))
+                if data:
+                    self.restore(data)
+            except Exception:
+                traceback.print_exc()
+
+        while not self.closed:
+            batch = [await inbox.get()]
+            while len(batch) < ACTOR_BATCH and not inbox.empty():
+                batch.append(inbox.get_nowait())
+
+            for command in batch:
+                if self.closed:
+                    # バッチの途中で部屋が追い出された: 残りは閉じた部屋では処理しない
+                    self.reject(command)
+                    continue
+                started = time.perf_counter()
+                # 1 つのコマンドの例外でアクターを止めない (計測も含めて try の中で行う)
+                try:
+                    queue_seconds.observe(started - command.queued_at)
+                    self.handle(command)
+                    kind = command.kind
+                    if kind == "message":
+                        kind = command.payload.get("type") if isinstance(command.payload, dict) else None
+                    # type はクライアントが送ってくる値なので、文字列以外はラベルにしない
+                    if not isinstance(kind, str) or kind not in handle_seconds:
+                        kind = "other"
+                    handle_seconds[kind].observe(time.perf_counter() - started)
+                except Exception:
+                    traceback.print_exc()
+
+            try:
+                if not self.closed:
+                    self.sync_turn_timer()
+                if STATE_TICK <= 0 and self._flush_handle is not None:
+                    self.flush_state()
+            except Exception:
+                traceback.print_exc()
+
+            # 最後の接続 (観戦者を含む) が抜け、入室待ちのコマンドもなければ部屋を破棄する
+            if not self.closed and not self.players and not self.spectators and inbox.empty():
+                self.close()
+
+        # 追い出された後に積まれていたコマンドも、入室・観戦の待ちを返してから捨てる
+        while not inbox.empty():
+            self.reject(inbox.get_nowait())
+
+    def reject(self, command: Command):
+        # 閉じた部屋に届いたコマンド。入室・観戦を待っている接続にはエラーを返す (接続側はそのまま閉じる)
+        if command.future is not None and not command.future.done():
+            command.future.set_result("ROOM_CLOSED")
+
+    def handle(self, command: Command):
+        kind = command.kind
+        self.snapshot_dirty = True
+        if kind == "message" or kind == "join":
+            self.last_active = time.time()
+        if kind == "message":
+            player_id = self.players.by_socket.get(command.websocket)
+            if player_id is not None:
+                self.handle_message(command.websocket, player_id, command.payload)
+        elif kind == "join":
+            session, _ = session_params(command.websocket)
+            if session in self.sessions:
+                # トークンはリプレイで変わるので、取り出す再接続データのキーで記録する
+                self.journal.append(ev.EV_RESUME, 0, 0, name_key(self.sessions[session]))
+            error = self.handle_join(command.websocket, command.payload)
+            player_id = 0 if error else self.players.by_socket[command.websocket]
+            self.journal.append(ev.EV_JOIN, player_id, 0, name_key(command.payload.strip()))
+            command.future.set_result(error)
+        elif kind == "watch":
+            command.future.set_result(self.handle_watch(command.websocket))
+        elif kind == "unwatch":
+            self.handle_unwatch(command.websocket)
+        elif kind == "leave":
+            player_id = self.players.by_socket.get(command.websocket)
+            if player_id is not None:
+                self.journal.append(ev.EV_LEAVE, player_id, command.payload or 0)
+            self.handle_leave(command.websocket, command.payload)
+        elif kind == "commit_clear":
+            if self._clear_handle is not None:
+                self.journal.append(ev.EV_COMMIT_CLEAR)
+            self.commit_clear()
+        elif kind == "turn_timeout":
+            if command.payload == self.turn_generation and self.is_playing and self.current_turn:
+                self.journal.append(ev.EV_TIMEOUT, self.current_turn)
+                self._turn_timer = None
+                # 時間切れ: 本人がパスしたのと同じ扱い
+                self.broadcast({"type": "turn_timeout", "player_id": self.current_turn})
+                self.end_turn()
+        elif kind == "bot_plan":
+            self.bot_plan(*command.payload)
+        elif kind == "bot_step":
+            self.bot_step(command.payload)
+        elif kind == "sweep":
+            self.sweep(*command.payload)
+        elif kind == "evict":
+            self.evict(command.payload)
+
+    def forget(self, name: str, reason: str):
+        # 再接続データを捨てる (リプレイで同じ状態になるように記録する)
+        data = self.disconnected_data.pop(name, None)
+        if data is not None:
+            self.sessions.pop(data.get('session'), None)
+            self.journal.append(ev.EV_FORGET, 0, 0, name_key(name))
+            evictions["disconnected_" + reason] += 1
+
+    def take_saved(self, key: str, by_session: bool) -> dict:
+        # 再接続データを取り出す。ゲストの分はトークンでしか取り出せない
+        data = self.disconnected_data.get(key)
+        if data is None or (data.get('guest') and not by_session):
+            return None
+        del self.disconnected_data[key]
+        self.sessions.pop(data.get('session'), None)
+        return data
+
+    def clear_saved(self):
+        self.disconnected_data.clear()
+        self.sessions.clear()
+
+    def events_since(self, last_seq: int) -> list:
+        # last_seq より後に送ったイベント。リングから押し出されていれば None (盤面ごと送り直す)
+        missed = self.event_seq - last_seq
+        if last_seq < 0 or missed < 0 or missed > len(self.events):
+            return None
+        return list(itertools.islice(self.events, len(self.events) - missed, None))
+
+    def sweep(self, ttl_cutoff: float, budget_cutoff: float):
+        # 期限切れ (left_at <= ttl_cutoff) と全体の上限を超えた分 (left_at <= budget_cutoff) を捨てる
+        for name, data in list(self.disconnected_data.items()):
+            if data['left_at'] <= ttl_cutoff:
+                self.forget(name, "ttl")
+            elif data['left_at'] <= budget_cutoff:
+                self.forget(name, "budget")
+
+    def evict(self, reason: str):
+        # 部屋ごとメモリから追い出す。スナップショットが有効なら状態を残し、次の入室で復元される
+        evictions["rooms_" + reason] += 1
+        self.suspended = True
+        frame = Frame({"type": "error", "message": "ROOM_CLOSED"})
+        for sender in list(self.senders.values()) + list(self.spectators.values()):
+            sender.push(frame)
+        for sender in self.senders.values():
+            sender.close()
+        self.close()
+
+    def sync_turn_timer(self):
+        # 手番が変わっていたら締め切りを付け直す (バッチの終わりに 1 回だけ)
+        key = (self.current_turn, self.turn_start_time) if self.is_playing and self.current_turn else None
+        if key == self._turn_key:
+            return
+        self._turn_key = key
+        if self._turn_timer is not None:
+            self._turn_timer.cancel()
+            self._turn_timer = None
+        if key is not None and TURN_TIMEOUT > 0:
+            self.turn_generation += 1
+            self._turn_timer = timer_wheel.schedule(
+                TURN_TIMEOUT, self.submit, Command("turn_timeout", payload=self.turn_generation))
 
     def rotate_turn(self):
-        self.skip_votes.clear()
+        self.players.skip_votes = 0
+        self.turn_combo = 0
         self.turn_start_time = time.time()
         self.total_turns_taken += 1
-        self.is_clearing = False
+        # 消去待ちならタイマーが確定するまで次の手番も置けない
+        self.is_clearing = self._clear_handle is not None
         
-        if not self.active_connections:
-            self.current_turn = 0
-            return
+        # ID の昇順で一周する (抜けた人の番だった場合は一番小さい ID から)
+        self.current_turn = self.players.next_turn(self.current_turn)
 
-        ids = sorted(list(self.active_connections.values()))
-        if self.current_turn == 0 or self.current_turn not in ids:
-            self.current_turn = ids[0]
-            return
+        self.journal.append(ev.EV_ROTATE, self.current_turn, self.total_turns_taken)
+        self.deal()
 
-        try:
-            current_index = ids.index(self.current_turn)
-            next_index = (current_index + 1) % len(ids)
-            self.current_turn = ids[next_index]
-        except ValueError:
-            self.current_turn = ids[0]
+    def handle_join(self, websocket: WebSocket, nickname: str, bot: bool = False):
+        # 入室できなければエラーメッセージを、できれば None を返す
+        if len(self.players) >= MAX_PLAYERS_PER_ROOM:
+            return "満員です"
 
-rooms: dict[str, GameRoom] = {}
-MAX_PLAYERS_PER_ROOM = 10
+        # 空いている一番小さい ID
+        current_player_id = self.players.free_seat()
+        
+        input_name = nickname.strip()
+        if bot:
+            # bot は記録にも再接続にも使わないのでゲストと同じ扱い
+            final_name, is_guest, chosen = f"Bot {current_player_id}", True, False
+        else:
+            # 名前なしや重複した名前の扱いはルールごとに違う
+            final_name, is_guest, chosen = self.rules.player_name(input_name, current_player_id, self.players.by_name)
+        if final_name is None:
+            return f"名前 '{input_name}' は既に使用されています。別の名前を使ってください。"
 
-@app.websocket("/ws/{room_id}")
-async def websocket_endpoint(websocket: WebSocket, room_id: str, nickname: str = ""):
-    if room_id not in rooms:
-        rooms[room_id] = GameRoom()
-    room = rooms[room_id]
-
-    if len(room.active_connections) >= MAX_PLAYERS_PER_ROOM:
-        await websocket.accept()
-        await websocket.send_json({"type": "error", "message": "満員です"})
-        await websocket.close()
-        return
+        # 登録
+        self.players.add(current_player_id, websocket, final_name, is_guest)
+        if chosen:
+            self.unranked &= ~(1 << current_player_id)
+        else:
+            self.unranked |= 1 << current_player_id
+        if bot:
+            self.bot_count += 1
+        else:
+            self.senders[websocket] = ConnectionSender(websocket, wants_binary(websocket))
+        
+        # トークンがあればその人のデータを、なければ名前で (ゲスト以外のみ) 復元
+        session, last_seq = session_params(websocket)
+        resumed = session in self.sessions
+        key = self.sessions[session] if resumed else (None if is_guest else final_name)
+        saved_data = self.take_saved(key, resumed) if key is not None else None
+        restored = saved_data is not None
+        if restored:
+            self.players.set_score(current_player_id, saved_data['score'])
+            if saved_data['was_host']:
+                self.host_id = current_player_id
+        if not bot:
+            self.session_tokens[current_player_id] = secrets.token_urlsafe(16)
 
-    await websocket.accept()
+        if not self.players.has(self.host_id) or self.is_bot(self.host_id):
+            self.host_id = self.first_human()
 
-    used_ids = set(room.active_connections.values())
-    current_player_id = 1
-    while current_player_id in used_ids:
-        current_player_id += 1
-    
-    input_name = nickname.strip()
-    final_name = ""
-    is_guest = False
-
-    if not input_name:
-        # 名前なし -> ゲスト扱い (Player N)
-        final_name = f"Player {current_player_id}"
-        is_guest = True
-    else:
-        # 名前あり -> 重複チェック
-        if input_name in room.names.values():
-            await websocket.send_json({"type": "error", "message": f"名前 '{input_name}' は既に使用されています。別の名前を使ってください。"})
-            await websocket.close()
-            return
-        final_name = input_name
-        is_guest = False
-
-    # 登録
-    room.active_connections[websocket] = current_player_id
-    room.names[current_player_id] = final_name
-    if is_guest:
-        room.guest_ids.add(current_player_id)
-    
-    # ゲスト以外のみデータを復元
-    restored = False
-    if not is_guest and final_name in room.disconnected_data:
-        saved_data = room.disconnected_data[final_name]
-        room.scores[current_player_id] = saved_data['score']
-        if saved_data['was_host']:
-            room.host_id = current_player_id
-        del room.disconnected_data[final_name]
-        restored = True
-    else:
-        room.scores[current_player_id] = 0
-
-    if room.host_id == 0 or room.host_id not in room.active_connections.values():
-        all_ids = sorted(list(room.active_connections.values()))
-        room.host_id = all_ids[0]
-
-    all_ids = sorted(list(room.active_connections.values()))
-    if room.current_turn == 0 or room.current_turn not in all_ids:
-        if all_ids:
-            room.current_turn = all_ids[0]
-            room.turn_start_time = time.time()
-
-    await websocket.send_json({
-        "type": "welcome",
-        "your_id": current_player_id,
-        "your_name": final_name,
-        "board": room.board,
-        "room_id": room_id,
-        "host_id": room.host_id,
-        "is_playing": room.is_playing,
-        "restored": restored
-    })
-
-    async def broadcast_room_state():
-        ranking = []
-        for pid, score in room.scores.items():
-            name = room.names.get(pid, f"Player {pid}")
-            ranking.append({"id": pid, "name": name, "score": score})
-        ranking.sort(key=lambda x: x["score"], reverse=True)
-
-        player_count = len(room.active_connections)
-        current_round = 1
-        if player_count > 0:
-            current_round = (room.total_turns_taken // player_count) + 1
+        if not self.players.has(self.current_turn):
+            self.current_turn = self.players.first()
+            self.turn_start_time = time.time()
+            self.deal()
 
-        message = {
-            "type": "game_state",
-            "count": player_count,
-            "ranking": ranking,
-            "current_turn": room.current_turn,
-            "turn_start_time": room.turn_start_time,
-            "skip_votes": list(room.skip_votes),
-            "reset_votes": list(room.reset_votes),
-            "host_id": room.host_id,
-            "is_playing": room.is_playing,
-            "round_info": f"{current_round}/{room.MAX_ROUNDS}",
-            "is_clearing": room.is_clearing,
-            "is_final": (current_round == room.MAX_ROUNDS)
+        # 同じ部屋で抜けていたイベントがリングに残っていれば、盤面は送らずにその分だけ送り直す
+        missed = self.events_since(last_seq) if resumed and last_seq is not None else None
+        if resumed:
+            resumes.inc("snapshot" if missed is None else "events")
+
+        welcome = {
+            "type": "welcome",
+            "your_id": current_player_id,
+            "your_name": final_name,
+            "room_id": self.room_id,
+            "variant": self.rules.name,
+            "host_id": self.host_id,
+            "is_playing": self.is_playing,
+            "restored": restored,
+            "resumed": resumed,
+            "session": self.session_tokens.get(current_player_id),
+            "event_seq": self.event_seq
         }
-        await room.broadcast(message)
+        if missed is None:
+            welcome["board"] = self.board.to_rows()
+        self.send_to(websocket, welcome)
+        for frame in missed or ():
+            self.send_to_frame(websocket, frame)
+
+        # 手番・手札・スコアは差分を送らず、完全な game_state で送り直す
+        self.mark_dirty(joined=websocket)
+        return None
+
+    def connected(self) -> bool:
+        # 送信できる接続 (プレイヤー・観戦者) が 1 つでも残っているか
+        return any(not sender.closed for sender in itertools.chain(self.senders.values(), self.spectators.values()))
 
-    await broadcast_room_state()
+    def first_human(self) -> int:
+        # ホストは bot 以外から選ぶ
+        for player_id in self.players.ids():
+            if not self.is_bot(player_id):
+                return player_id
+        return 0
 
-    async def check_votes_and_execute():
-        player_count = len(room.active_connections)
+    def check_votes_and_execute(self):
+        # bot は投票しないので人間の数で数える
+        player_count = len(self.players) - self.bot_count
         if player_count == 0: return
 
-        if len(room.reset_votes) >= player_count:
-            room.board = [[0] * 8 for _ in range(8)]
-            for pid in room.scores: room.scores[pid] = 0
-            room.reset_votes.clear()
-            room.skip_votes.clear()
-            room.total_turns_taken = 0
-            room.disconnected_data.clear()
-            room.is_playing = False 
+        if self.players.reset_votes.bit_count() >= player_count:
+            self.cancel_clear()
+            self.board.reset()
+            self.sync_placements()
+            self.players.reset_scores()
+            self.players.reset_votes = 0
+            self.players.skip_votes = 0
+            self.total_turns_taken = 0
+            self.turn_combo = 0
+            self.clear_saved()
+            self.is_playing = False 
             
-            ids = sorted(list(room.active_connections.values()))
-            if ids:
-                room.current_turn = ids[0]
-                room.turn_start_time = time.time()
+            self.current_turn = self.players.first()
+            self.turn_start_time = time.time()
             
-            await room.broadcast({"type": "init", "board": room.board})
-            await broadcast_room_state()
+            self.journal.append(ev.EV_RESET)
+            self.deal()
+            self.broadcast({"type": "init", "board": self.board.to_rows()})
+            self.mark_dirty()
             return
 
         required_skips = max(1, player_count - 1)
-        if len(room.skip_votes) >= required_skips:
-            room.rotate_turn()
-            await broadcast_room_state()
+        if self.players.skip_votes.bit_count() >= required_skips:
+            self.rotate_turn()
+            self.mark_dirty()
 
-    try:
-        while True:
-            data = await websocket.receive_text()
+    def end_turn(self):
+        player_count = len(self.players)
+        
+        # ▼▼▼ 修正箇所 ▼▼▼
+        # 終了の判定はルールごとに違う (classic は最終ラウンドの最後の人が操作を終えた瞬間に終了)
+        # ゲームの前後 (is_playing でない間) に置いて手番を回しても、ゲーム終了にも記録にもしない
+        if self.is_playing and self.rules.is_game_over(self.total_turns_taken, player_count, self.MAX_ROUNDS):
+            self.is_playing = False
+            final_ranking = self.players.ranking()
+            
+            self.journal.append(ev.EV_GAME_OVER, final_ranking[0]["id"] if final_ranking else 0)
+            self.broadcast({"type": "game_over", "ranking": final_ranking})
+            if leaderboard is not None:
+                # 自動で付けた名前 (ゲスト・"Player N"・"名前 2" など) は別の人と区別できないので記録しない
+                leaderboard.record(self.room_id, self.rules.name, final_ranking,
+                                   [pid for pid in self.players.ids() if (self.unranked >> pid) & 1])
+            self.total_turns_taken = 0
+            self.clear_saved()
+            # 次のゲームまでの間も置けるように配り直す
+            self.deal()
+            self.mark_dirty()
+        else:
+            # まだ続くならターンを進める
+            self.rotate_turn()
+            self.mark_dirty()
+        # ▲▲▲ 修正ここまで ▲▲▲
+
+    def handle_message(self, websocket: WebSocket, current_player_id: int, message: dict):
+        msg_type = message.get("type")
+
+        if msg_type == "start_game":
             try:
-                message = json.loads(data)
-                msg_type = message.get("type")
-
-                if msg_type == "start_game":
-                    if current_player_id == room.host_id:
-                        try:
-                            rounds = int(message.get("max_rounds", 100))
-                            room.MAX_ROUNDS = rounds if rounds > 0 else 100
-                        except:
-                            room.MAX_ROUNDS = 100
-                        
-                        room.is_playing = True
-                        room.total_turns_taken = 0
-                        room.current_turn = room.host_id
-                        room.turn_start_time = time.time()
-                        await room.broadcast({"type": "game_start"})
-                        await broadcast_room_state()
-
-                elif msg_type == "kick_player":
-                    if current_player_id == room.host_id:
-                        target_id = message.get("target_id")
-                        target_ws = None
-                        for ws, pid in list(room.active_connections.items()):
-                            if pid == target_id:
-                                target_ws = ws
-                                break
-                        if target_ws:
-                            await target_ws.send_json({"type": "error", "message": "KICKED"})
-                            await target_ws.close()
-
-                elif msg_type == "batch_update":
-                    if room.current_turn != current_player_id or room.is_clearing:
-                         continue
-
-                    updates = message["updates"]
-                    for item in updates:
-                        r, c, v = item["row"], item["col"], item["value"]
-                        if 0 <= r < 8 and 0 <= c < 8:
-                            room.board[r][c] = v
-                    
-                    await room.broadcast(message)
-
-                    rows_to_clear = []
-                    cols_to_clear = []
-                    for r in range(8):
-                        if all(room.board[r][c] == 1 for c in range(8)): rows_to_clear.append(r)
-                    for c in range(8):
-                        if all(room.board[r][c] == 1 for r in range(8)): cols_to_clear.append(c)
-
-                    if rows_to_clear or cols_to_clear:
-                        room.is_clearing = True
-                        await broadcast_room_state()
-
-                        lines_count = len(rows_to_clear) + len(cols_to_clear)
-                        points = lines_count * 10
-                        if current_player_id in room.scores:
-                            room.scores[current_player_id] += points
-                        
-                        await asyncio.sleep(0.3)
-                        cleared_updates = []
-                        for r in rows_to_clear:
-                            for c in range(8):
-                                room.board[r][c] = 0
-                                cleared_updates.append({"row": r, "col": c, "value": 0})
-                        for c in cols_to_clear:
-                            for r in range(8):
-                                room.board[r][c] = 0
-                                cleared_updates.append({"row": r, "col": c, "value": 0})
-                        
-                        await room.broadcast({"type": "batch_update", "updates": cleared_updates})
-                        room.is_clearing = False
-                        await broadcast_room_state()
-
-                elif msg_type == "end_turn" or msg_type == "pass_turn":
-                    if room.current_turn == current_player_id:
-                        player_count = len(room.active_connections)
-                        
-                        # ▼▼▼ 修正箇所 ▼▼▼
-                        # 次の総ターン数 (現在のターンが終わった後の状態)
-                        next_total_turns = room.total_turns_taken + 1
-                        # 最大許容ターン数 (人数 × ラウンド数)
-                        max_possible_turns = player_count * room.MAX_ROUNDS
-
-                        # `>=` を使うことで、最終ラウンドの最後の人が操作を終えた瞬間に終了します
-                        if next_total_turns >= max_possible_turns:
-                            room.is_playing = False
-                            final_ranking = []
-                            for pid, score in room.scores.items():
-                                name = room.names.get(pid, f"Player {pid}")
-                                final_ranking.append({"id": pid, "name": name, "score": score})
-                            final_ranking.sort(key=lambda x: x["score"], reverse=True)
-                            
-                            await room.broadcast({"type": "game_over", "ranking": final_ranking})
-                            room.total_turns_taken = 0
-                            room.disconnected_data.clear()
-                        else:
-                            # まだ続くならターンを進める
-                            room.rotate_turn()
-                            await broadcast_room_state()
-                        # ▲▲▲ 修正ここまで ▲▲▲
-                
-                elif msg_type == "vote_reset":
-                    if current_player_id in room.reset_votes: room.reset_votes.remove(current_player_id)
-                    else: room.reset_votes.add(current_player_id)
-                    await broadcast_room_state()
-                    await check_votes_and_execute()
-                
-                elif msg_type == "vote_skip":
-                    if room.current_turn != current_player_id:
-                        if current_player_id in room.skip_votes: room.skip_votes.remove(current_player_id)
-                        else: room.skip_votes.add(current_player_id)
-                        await broadcast_room_state()
-                        await check_votes_and_execute()
+                rounds = int(message.get("max_rounds", 100))
+            except:
+                rounds = 0
+            self.journal.append(ev.EV_START, current_player_id, 0, max(rounds, 0))
+
+            if current_player_id == self.host_id:
+                # バイナリ形式とスナップショットは 32bit で書くので上限を付ける
+                self.MAX_ROUNDS = min(rounds, MAX_ROUNDS_LIMIT) if rounds > 0 else 100
                 
-                elif msg_type == "veto_skip":
-                    if room.current_turn == current_player_id:
-                        room.skip_votes.clear()
-                        await broadcast_room_state()
+                self.is_playing = True
+                self.total_turns_taken = 0
+                self.turn_combo = 0
+                self.current_turn = self.host_id
+                self.turn_start_time = time.time()
+                self.deal()
+                self.broadcast({"type": "game_start"})
+                self.mark_dirty()
 
-            except Exception:
-                traceback.print_exc()
+        elif msg_type == "kick_player":
+            target_id = message.get("target_id")
+            if isinstance(target_id, int):
+                self.journal.append(ev.EV_KICK, current_player_id, target_id)
+            if current_player_id == self.host_id:
+                target_ws = self.players.socket_of(target_id)
+                if isinstance(target_ws, BotSocket):
+                    self.handle_leave(target_ws)
+                elif target_ws:
+                    self.send_to(target_ws, {"type": "error", "message": "KICKED"})
+                    self.senders[target_ws].close()
+
+        elif msg_type == "add_bot":
+            self.journal.append(ev.EV_ADD_BOT, current_player_id)
+            if current_player_id == self.host_id:
+                # 満員なら何もしない
+                self.handle_join(BotSocket(), "", bot=True)
+
+        elif msg_type == "batch_update":
+            # 1 つのピースを空いているマスにちょうど 1 回置いたものだけを受け付ける (不正なら 0)
+            # バイナリ形式のクライアントは updates の代わりにマスクを送ってくる
+            mask = message.get("mask")
+            if mask is not None:
+                set_mask = mask if type(mask) is int and mask in PLACEMENTS else 0
+            else:
+                set_mask = placement_mask(message.get("updates"))
+            self.journal.append(ev.EV_PLACE, current_player_id, 0, set_mask)
+
+            shape = PLACEMENTS.get(set_mask)
+            reason = None
+            if self.current_turn != current_player_id or self.is_clearing:
+                # 手番が (時間切れなどで) 移った後や、消去の確定待ちに届いた
+                reason = "turn"
+            elif shape is None:
+                reason = "shape"
+            elif set_mask & self.board.bits:
+                reason = "occupied"
+            elif shape not in self.hand:
+                reason = "hand"
+            if reason:
+                rejected_moves.inc(reason)
+                # 送った側は先に盤面と手札を書き換えているので、正しい状態に戻させる
+                self.send_to(websocket, {"type": "move_rejected", "board": self.board.to_rows(),
+                                         "hand": self.hand_shapes()})
+                return
 
-    except WebSocketDisconnect:
-        if websocket in room.active_connections:
-            is_guest = (current_player_id in room.guest_ids)
-            if not is_guest:
-                room.disconnected_data[final_name] = {
-                    'score': room.scores.get(current_player_id, 0),
-                    'was_host': (room.host_id == current_player_id)
-                }
+            self.board.apply_masks(set_mask)
+            self.hand[self.hand.index(shape)] = None
             
-            del room.active_connections[websocket]
-            if is_guest: room.guest_ids.discard(current_player_id)
+            self.broadcast({"type": "batch_update", "updates": mask_to_updates(set_mask, 1)})
+
+            clear_mask, lines_count = self.board.find_lines()
+
+            if clear_mask:
+                points, self.turn_combo = self.rules.score(lines_count, self.turn_combo)
+                self.journal.append(ev.EV_CLEAR, current_player_id, points, clear_mask)
+                self.players.add_points(current_player_id, points)
+
+                # 消去アニメーション分待ってから確定する (受信ループは止めない)
+                self.schedule_clear(clear_mask)
+
+            self.sync_placements()
+            self.mark_dirty()
+            if not any(shape is not None for shape in self.hand):
+                # 手札を使い切ったら手番を終える
+                self.end_turn()
+            elif self.is_playing and not any(self.placements.placeable(shape)
+                                             for shape in self.hand if shape is not None):
+                # 残りの手札がどこにも置けない: 自動でパスする
+                self.journal.append(ev.EV_AUTO_PASS, current_player_id)
+                self.broadcast({"type": "auto_pass", "player_id": current_player_id})
+                self.end_turn()
+
+        elif msg_type == "end_turn" or msg_type == "pass_turn":
+            self.journal.append(ev.EV_END_TURN if msg_type == "end_turn" else ev.EV_PASS_TURN, current_player_id)
+            if self.current_turn == current_player_id:
+                self.end_turn()
         
-        if current_player_id in room.scores: del room.scores[current_player_id]
-        if current_player_id in room.names: del room.names[current_player_id]
-        if current_player_id in room.skip_votes: room.skip_votes.remove(current_player_id)
-        if current_player_id in room.reset_votes: room.reset_votes.remove(current_player_id)
-
-        if room.host_id == current_player_id:
-            if room.active_connections:
-                new_host = sorted(room.active_connections.values())[0]
-                room.host_id = new_host
-            else:
-                room.host_id = 0
+        elif msg_type == "vote_reset":
+            self.journal.append(ev.EV_VOTE_RESET, current_player_id)
+            self.players.reset_votes ^= 1 << current_player_id
+            self.mark_dirty()
+            self.check_votes_and_execute()
+        
+        elif msg_type == "vote_skip":
+            self.journal.append(ev.EV_VOTE_SKIP, current_player_id)
+            if self.current_turn != current_player_id:
+                self.players.skip_votes ^= 1 << current_player_id
+                self.mark_dirty()
+                self.check_votes_and_execute()
+        
+        elif msg_type == "sync_state":
+            # クライアントが seq の欠落を検出した: 完全なスナップショットを送り直す
+            self.send_to_frame(websocket, self.snapshot_frame())
 
-        if room.current_turn == current_player_id:
-            room.rotate_turn()
+        elif msg_type == "veto_skip":
+            self.journal.append(ev.EV_VETO, current_player_id)
+            if self.current_turn == current_player_id:
+                self.players.skip_votes = 0
+                self.mark_dirty()
 
-        if len(room.active_connections) == 0:
-            del rooms[room_id]
-        else:
-            await broadcast_room_state()
-            await check_votes_and_execute()
\ No newline at end of file
+    def handle_leave(self, websocket: WebSocket, code: int = None):
+        if code == 1012:
+            # サーバーの再起動による切断
+            self.suspended = True
+        sender = self.senders.pop(websocket, None)
+        if sender:
+            sender.cancel()
+
+        if websocket not in self.players.by_socket:
+            return
+        current_player_id = self.players.by_socket[websocket]
+        final_name = self.players.names[current_player_id]
+        is_guest = self.players.is_guest(current_player_id)
+        token = self.session_tokens.pop(current_player_id, None)
+
+        if not is_guest or token is not None:
+            key = final_name
+            if is_guest:
+                self.guest_leaves += 1
+                key = f"{final_name}#{self.guest_leaves}"
+            self.disconnected_data[key] = {
+                'score': self.players.scores[current_player_id],
+                'was_host': (self.host_id == current_player_id),
+                'left_at': time.time(),
+                'guest': is_guest,
+                'session': token
+            }
+            if token is not None:
+                self.sessions[token] = key
+            # 上限を超えたら一番昔に抜けた人から消す (抜けた順に並んでいる)
+            if DISCONNECT_MAX > 0 and len(self.disconnected_data) > DISCONNECT_MAX:
+                self.forget(next(iter(self.disconnected_data)), "lru")
+        
+        # 名前・スコア・投票も一緒に消える
+        self.players.remove(websocket)
+        if isinstance(websocket, BotSocket):
+            self.bot_count -= 1
+
+        if self.suspended:
+            # 再起動で全員が切れていく途中: ホストも手番もラウンドも変えず、切れた時点の状態でスナップショットに残す
+            if self.players and self.bot_count == len(self.players):
+                for player_id in list(self.players.ids()):
+                    self.handle_leave(self.players.socket_of(player_id))
+            return
+
+        if self.host_id == current_player_id:
+            self.host_id = self.first_human()
+
+        if self.current_turn == current_player_id:
+            self.rotate_turn()
+
+        if self.players and self.bot_count == len(self.players):
+            # 人間が全員抜けたら bot も外す (部屋を破棄できるように)
+            for player_id in list(self.players.ids()):
+                self.handle_leave(self.players.socket_of(player_id))
+        elif self.players:
+            self.mark_dirty()
+            self.check_votes_and_execute()
+
+rooms: dict[str, GameRoom] = {}
+MAX_PLAYERS_PER_ROOM = 10
+# start_game で指定できるラウンド数の上限
+MAX_ROUNDS_LIMIT = 1000
+# アクターが 1 回にまとめて処理するコマンド数の上限
+ACTOR_BATCH = 64
+# シャーディング時 (shard.py から起動) の自分の担当番号と総数
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+
+def get_room(room_id: str, variant: str = "") -> GameRoom:
+    # ルールは部屋を作る時だけ決まる (既にある部屋に入る時の variant は無視する)
+    room = rooms.get(room_id)
+    if room is None:
+        room = rooms[room_id] = GameRoom(room_id, rules=rules_for(variant))
+    return room
+
+@app.websocket("/ws/{room_id}")
+async def websocket_endpoint(websocket: WebSocket, room_id: str, nickname: str = "", spectate: bool = False,
+                             variant: str = ""):
+    await websocket.accept()
+
+    if SHARD_COUNT > 1 and shard_for(room_id, SHARD_COUNT) != SHARD_INDEX:
+        # 担当外の部屋: 別プロセスに同じ部屋ができてしまわないよう受け付けない
+        await websocket.send_json({"type": "error", "message": "WRONG_SHARD"})
+        await websocket.close()
+        return
+
+    code = None
+    # 部屋の取得からコマンド投入までの間に await を挟まない (アクターによる部屋の破棄と競合しないように)
+    room = get_room(room_id, variant)
+    joined = asyncio.get_running_loop().create_future()
+    # spectate=1 なら観戦者として入る (プレイヤーの人数に数えない)
+    room.submit(Command("watch" if spectate else "join", websocket, nickname, joined))
+
+    try:
+        error = await joined
+        if error:
+            await websocket.send_json({"type": "error", "message": error})
+            await websocket.close()
+            return
+
+        while True:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                code = received.get("code", 1000)
+                break
+            if spectate:
+                # 観戦者は読み取り専用: 送られてきたものは読み捨てる (切断の検出のためだけに受信する)
+                continue
+            try:
+                text = received.get("text")
+                message = json.loads(text) if text is not None else wire.decode(received.get("bytes") or b"")
+                if message is not None:
+                    room.submit(Command("message", websocket, message))
+            except Exception:
+                traceback.print_exc()
+
+    except WebSocketDisconnect as e:
+        code = e.code
+    finally:
+        room.submit(Command("unwatch" if spectate else "leave", websocket, code))
+
+def save_snapshots(only_dirty: bool = True):
+    # エンコードはループ上で (一貫した状態を読むため)、書き込みは専用スレッドで行う
+    for room in list(rooms.values()):
+        if room.snapshot_dirty or not only_dirty:
+            room.snapshot_dirty = False
+            snapshot_store.save(room.room_id, encode_room(room))
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            save_snapshots()
+        except Exception:
+            traceback.print_exc()
+
+def flush_journals():
+    # 溜まったログをまとめて専用スレッドに渡す
+    for room in list(rooms.values()):
+        if room.journal.buffer:
+            journal_store.write(room.room_id, room.journal.take())
+
+async def journal_loop():
+    while True:
+        await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+        try:
+            flush_journals()
+        except Exception:
+            traceback.print_exc()
+
+async def leaderboard_loop():
+    while True:
+        await asyncio.sleep(LEADERBOARD_FLUSH_INTERVAL)
+        try:
+            leaderboard.flush()
+        except Exception:
+            traceback.print_exc()
+
+def sweep_rooms(now: float):
+    # 状態の変更は各部屋のアクターに任せ、ここでは何を消すかを決めてコマンドを送るだけ
+    ttl_cutoff = now - DISCONNECT_TTL if DISCONNECT_TTL > 0 else float("-inf")
+    budget_cutoff = float("-inf")
+    left_at = [data['left_at'] for room in rooms.values() for data in room.disconnected_data.values()
+               if data['left_at'] > ttl_cutoff]
+    if DISCONNECT_BUDGET > 0 and len(left_at) > DISCONNECT_BUDGET:
+        budget_cutoff = max(heapq.nsmallest(len(left_at) - DISCONNECT_BUDGET, left_at))
+
+    live = []
+    for room in list(rooms.values()):
+        # 接続が残っている部屋は静かでも放置とはみなさない (追い出すのは MAX_ROOMS の上限だけ)
+        if ROOM_IDLE_TTL > 0 and now - room.last_active > ROOM_IDLE_TTL and not room.connected():
+            room.submit(Command("evict", payload="idle"))
+            continue
+        live.append(room)
+        if room.disconnected_data:
+            room.submit(Command("sweep", payload=(ttl_cutoff, budget_cutoff)))
+
+    if MAX_ROOMS > 0 and len(live) > MAX_ROOMS:
+        live.sort(key=lambda room: room.last_active)
+        for room in live[:len(live) - MAX_ROOMS]:
+            room.submit(Command("evict", payload="budget"))
+
+async def lifecycle_loop():
+    while True:
+        await asyncio.sleep(LIFECYCLE_INTERVAL)
+        try:
+            sweep_rooms(time.time())
+        except Exception:
+            traceback.print_exc()
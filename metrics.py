@@ -0,0 +1,88 @@
+# 運用向けのメトリクス (Prometheus のテキスト形式で /metrics に出す)
+# 記録はホットパスで呼ばれるので、バケットは最初に確保しておき、記録時は整数の加算だけにする
+from bisect import bisect_right
+
+# 秒単位のバケット (50us 〜 1s)
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 16, 32, 64)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        # 最後の 1 つは +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_right(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Counters:
+    # 名前の決まった整数カウンタの集まり。未知の名前はエラーにする (記録時に dict を増やさない)
+    __slots__ = ("values",)
+
+    def __init__(self, *names: str):
+        self.values = dict.fromkeys(names, 0)
+
+    def inc(self, name: str, amount: int = 1):
+        self.values[name] += amount
+
+
+def _format(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_histogram(lines: list, name: str, help_text: str, histograms: dict, label: str = None):
+    # histograms: {ラベル値: Histogram}。label が None なら {None: Histogram} の 1 本だけ
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, hist in histograms.items():
+        prefix = f'{label}="{key}",' if label else ""
+        cumulative = 0
+        for bound, count in zip(hist.bounds, hist.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {hist.count}')
+        labels = f"{{{prefix[:-1]}}}" if prefix else ""
+        lines.append(f"{name}_sum{labels} {_format(hist.sum)}")
+        lines.append(f"{name}_count{labels} {hist.count}")
+
+
+def merge_shards(texts: list[tuple[int, str]]) -> str:
+    # シャーディング時: 各ワーカーの /metrics を 1 つにまとめ、サンプルに shard ラベルを付ける
+    families: dict[str, tuple[list, list]] = {}
+    for shard, text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                family = families.setdefault(line.split()[2], ([], []))
+                if not family[0]:
+                    family[0].append(line)
+            elif line.startswith("# TYPE "):
+                if family is not None and len(family[0]) < 2:
+                    family[0].append(line)
+            elif line and family is not None:
+                sample, value = line.rsplit(" ", 1)
+                label = f'shard="{shard}"'
+                sample = sample[:-1] + "," + label + "}" if sample.endswith("}") else sample + "{" + label + "}"
+                family[1].append(f"{sample} {value}")
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def render_value(lines: list, name: str, kind: str, help_text: str, values: dict, label: str = None):
+    # kind: counter / gauge。values: {ラベル値: 値}。label が None なら {None: 値}
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for key, value in values.items():
+        labels = f'{{{label}="{key}"}}' if label else ""
+        lines.append(f"{name}{labels} {_format(value)}")
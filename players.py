@@ -0,0 +1,151 @@
+# 部屋のプレイヤー表
+# プレイヤー ID (1〜定員) をそのまま席番号にして配列で持つ。使用中の席・ゲスト・投票はビットマップ
+# 手番の順番 (ID の昇順で一周) は ring[ID] = 次の ID の輪で持ち、入退室の時につなぎ直す
+# 順位 (スコアの高い順、同点は入室順) もスコアが変わった時だけ並べ直し、送信用のリストを使い回す
+from array import array
+from bisect import insort
+
+
+def _lowest(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+
+class PlayerTable:
+    __slots__ = ("capacity", "occupied", "guests", "skip_votes", "reset_votes",
+                 "sockets", "names", "scores", "joined", "ring", "by_socket", "by_name",
+                 "order", "_ranking", "_join_seq", "_seats")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        size = capacity + 1
+        # ビット i が ID i に対応する (ID 0 は「いない」なので使わない)
+        self.occupied = 0
+        self.guests = 0
+        self.skip_votes = 0
+        self.reset_votes = 0
+        self.sockets: list = [None] * size
+        self.names: list[str] = [""] * size
+        self.scores = array("i", bytes(4 * size))
+        # 入室順 (同点の順位を入室順にするため)
+        self.joined = array("I", bytes(4 * size))
+        self.ring = array("B", bytes(size))
+        self.by_socket: dict = {}
+        self.by_name: dict[str, int] = {}
+        # 順位順の ID と、それから作った ranking (スコアが変わるまで同じリストを返す)
+        self.order: list[int] = []
+        self._ranking: list[dict] = None
+        self._join_seq = 0
+        self._seats = ((1 << size) - 1) & ~1
+
+    def __len__(self):
+        return len(self.by_socket)
+
+    def has(self, player_id) -> bool:
+        return isinstance(player_id, int) and 0 < player_id <= self.capacity and (self.occupied >> player_id) & 1 == 1
+
+    def ids(self):
+        # 使用中の ID を昇順に
+        mask = self.occupied
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def first(self) -> int:
+        return _lowest(self.occupied) if self.occupied else 0
+
+    def free_seat(self) -> int:
+        # 空いている一番小さい ID (満席なら 0)
+        free = self._seats & ~self.occupied
+        return _lowest(free) if free else 0
+
+    def is_guest(self, player_id: int) -> bool:
+        return (self.guests >> player_id) & 1 == 1
+
+    def socket_of(self, player_id):
+        return self.sockets[player_id] if self.has(player_id) else None
+
+    def add(self, player_id: int, socket, name: str, is_guest: bool, score: int = 0):
+        bit = 1 << player_id
+        if self.occupied:
+            # 輪の中で自分の前になる ID (自分より小さい最大の ID、なければ一番大きい ID) の後ろに入る
+            below = self.occupied & (bit - 1)
+            prev = (below or self.occupied).bit_length() - 1
+            self.ring[player_id] = self.ring[prev]
+            self.ring[prev] = player_id
+        else:
+            self.ring[player_id] = player_id
+        self.occupied |= bit
+        if is_guest:
+            self.guests |= bit
+        self.sockets[player_id] = socket
+        self.names[player_id] = name
+        self.scores[player_id] = score
+        self._join_seq += 1
+        self.joined[player_id] = self._join_seq
+        self.by_socket[socket] = player_id
+        self.by_name.setdefault(name, player_id)
+        insort(self.order, player_id, key=self._rank_key)
+        self._ranking = None
+
+    def remove(self, socket) -> int:
+        player_id = self.by_socket.pop(socket)
+        bit = 1 << player_id
+        self.occupied &= ~bit
+        self.guests &= ~bit
+        self.skip_votes &= ~bit
+        self.reset_votes &= ~bit
+        if self.occupied:
+            below = self.occupied & (bit - 1)
+            prev = (below or self.occupied).bit_length() - 1
+            self.ring[prev] = self.ring[player_id]
+        self.ring[player_id] = 0
+        name = self.names[player_id]
+        if self.by_name.get(name) == player_id:
+            del self.by_name[name]
+        self.sockets[player_id] = None
+        self.names[player_id] = ""
+        self.scores[player_id] = 0
+        self.order.remove(player_id)
+        self._ranking = None
+        return player_id
+
+    def next_turn(self, player_id: int) -> int:
+        # 次の手番。いなくなった人の番だった場合は一番小さい ID から
+        if self.has(player_id):
+            return self.ring[player_id]
+        return self.first()
+
+    def _rank_key(self, player_id: int):
+        return -self.scores[player_id], self.joined[player_id]
+
+    def set_score(self, player_id: int, score: int):
+        if self.scores[player_id] == score:
+            return
+        self.order.remove(player_id)
+        self.scores[player_id] = score
+        insort(self.order, player_id, key=self._rank_key)
+        self._ranking = None
+
+    def add_points(self, player_id: int, points: int):
+        self.set_score(player_id, self.scores[player_id] + points)
+
+    def reset_scores(self):
+        for player_id in self.ids():
+            self.scores[player_id] = 0
+        self.order.sort(key=self.joined.__getitem__)
+        self._ranking = None
+
+    def vote_ids(self, votes: int) -> list[int]:
+        ids = []
+        while votes:
+            low = votes & -votes
+            ids.append(low.bit_length() - 1)
+            votes ^= low
+        return ids
+
+    def ranking(self) -> list[dict]:
+        # 受け取った側は書き換えないこと (次にスコアが変わるまで同じリストを返す)
+        if self._ranking is None:
+            self._ranking = [{"id": pid, "name": self.names[pid], "score": self.scores[pid]} for pid in self.order]
+        return self._ranking
@@ -0,0 +1,172 @@
+# 操作ログを同じゲームロジックに流し直す (最速で、ソケットもタイマーも使わない)
+# 記録された結果 (ライン消去・手番・ゲーム終了など) と再計算した結果を突き合わせる
+#
+#   python replay.py journal/<hash>.log [--dump]
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import journal as ev
+from bitboard import mask_to_updates
+from rules import RULES_BY_ID
+
+
+class ReplaySocket:
+    # 送信を捨てるだけのダミー接続。再接続ならリプレイ側の部屋が発行したトークンを持たせる
+    def __init__(self, session: str = None):
+        self.query_params = {"session": session} if session else {}
+
+    async def send_text(self, text):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def describe(record) -> str:
+    ts, kind, player_id, arg, value = record
+    return f"{ev.EVENT_NAMES.get(kind, kind)} player={player_id} arg={arg} value={value:#x}"
+
+
+async def replay(data: bytes, dump: bool = False) -> dict:
+    import main
+
+    # リプレイ中はディスクに何も書かない
+    main.snapshot_store = None
+    main.journal_store = None
+    main.leaderboard = None
+
+    loop = asyncio.get_running_loop()
+    records = list(ev.iter_records(data))
+    segments = []
+    mismatches = []
+    room = None
+    sockets = {}
+    expected = []
+    pending_session = None
+    last_scores = {}
+
+    def finish():
+        if room is None:
+            return
+        produced = [r[1:] for r in ev.iter_records(room.journal.take()) if r[1] in ev.OUTCOME_EVENTS]
+        wanted = [r[1:] for r in expected]
+        for i, (want, got) in enumerate(zip(wanted, produced)):
+            if want != got:
+                mismatches.append({"segment": len(segments), "index": i,
+                                   "recorded": describe((0,) + want), "replayed": describe((0,) + got)})
+                break
+        if len(wanted) != len(produced):
+            mismatches.append({"segment": len(segments), "recorded_outcomes": len(wanted),
+                               "replayed_outcomes": len(produced)})
+        segments.append({"scores": last_scores,
+                         "board": f"{room.board.bits:#018x}", "outcomes": len(produced)})
+        room.close()
+        room._actor.cancel()
+
+    def saved_key(value: int) -> str:
+        # 記録されたハッシュに当たる再接続データのキー (名前はハッシュの 16 進、ゲストは「名前#番号」のまま)
+        return next((key for key in room.disconnected_data
+                     if key == f"{value:016x}" or ev.name_key(key) == value), None)
+
+    def message(player_id: int, payload: dict):
+        # bot の席は部屋の中で作られるので、部屋のプレイヤー表から接続を引く
+        socket = sockets.get(player_id) or room.players.socket_of(player_id)
+        room.handle(main.Command("message", socket, payload))
+
+    started = time.perf_counter()
+    placements = 0
+    for record in records:
+        ts, kind, player_id, arg, value = record
+        if dump:
+            print(describe(record))
+
+        if kind == ev.EV_OPEN:
+            finish()
+            room = main.GameRoom("replay", seed=value, rules=RULES_BY_ID.get(arg))
+            room.journal.take()
+            sockets = {}
+            expected = []
+            last_scores = {}
+        elif room is None:
+            continue
+        elif kind in ev.OUTCOME_EVENTS:
+            expected.append(record)
+            if kind == ev.EV_RESTORE:
+                room.restore({"board": value, "max_rounds": room.MAX_ROUNDS, "total_turns_taken": arg,
+                              "is_playing": room.is_playing, "variant": player_id, "players": {}})
+        elif kind == ev.EV_RESUME:
+            # 記録されたキーの再接続データを持つ、リプレイ側のトークンで入り直す
+            data = room.disconnected_data.get(saved_key(value))
+            pending_session = data.get('session') if data else None
+        elif kind == ev.EV_JOIN:
+            socket = ReplaySocket(pending_session)
+            pending_session = None
+            joined = loop.create_future()
+            room.handle(main.Command("join", socket, "" if value == 0 else f"{value:016x}", joined))
+            if not joined.result():
+                sockets[room.players.by_socket[socket]] = socket
+        elif kind == ev.EV_LEAVE:
+            room.handle(main.Command("leave", sockets.pop(player_id, None), arg or None))
+        elif kind == ev.EV_START:
+            message(player_id, {"type": "start_game", "max_rounds": value})
+        elif kind == ev.EV_PLACE:
+            placements += 1
+            message(player_id, {"type": "batch_update", "updates": mask_to_updates(value, 1)})
+        elif kind == ev.EV_END_TURN:
+            message(player_id, {"type": "end_turn"})
+        elif kind == ev.EV_PASS_TURN:
+            message(player_id, {"type": "pass_turn"})
+        elif kind == ev.EV_VOTE_SKIP:
+            message(player_id, {"type": "vote_skip"})
+        elif kind == ev.EV_VOTE_RESET:
+            message(player_id, {"type": "vote_reset"})
+        elif kind == ev.EV_VETO:
+            message(player_id, {"type": "veto_skip"})
+        elif kind == ev.EV_KICK:
+            message(player_id, {"type": "kick_player", "target_id": arg})
+        elif kind == ev.EV_ADD_BOT:
+            message(player_id, {"type": "add_bot"})
+        elif kind == ev.EV_COMMIT_CLEAR:
+            room.handle(main.Command("commit_clear"))
+        elif kind == ev.EV_TIMEOUT:
+            room.handle(main.Command("turn_timeout", payload=room.turn_generation))
+        elif kind == ev.EV_FORGET:
+            # 名前はハッシュで記録されているので、リプレイ側のキーを探して消す
+            data = room.disconnected_data.pop(saved_key(value), None)
+            if data:
+                room.sessions.pop(data.get('session'), None)
+
+        if room is not None:
+            # 抜けたプレイヤーのスコアも消えないように、名前ごとに最後の値を残す
+            last_scores.update((room.players.names[pid], room.players.scores[pid]) for pid in room.players.ids())
+    finish()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "records": len(records),
+        "placements": placements,
+        "segments": segments,
+        "mismatches": mismatches,
+        "elapsed_sec": round(elapsed, 6),
+        "records_per_sec": round(len(records) / elapsed) if elapsed > 0 else None,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("journal")
+    parser.add_argument("--dump", action="store_true", help="レコードを 1 行ずつ表示する")
+    args = parser.parse_args()
+
+    with open(args.journal, "rb") as f:
+        data = f.read()
+    result = asyncio.run(replay(data, args.dump))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    sys.exit(1 if result["mismatches"] else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
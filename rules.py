@@ -0,0 +1,92 @@
+# ルールの種類 (部屋を作る時に選ぶ)。得点・名前の付け方・ゲーム終了の判定だけが違い、
+# 接続・送信・盤面の処理は全部屋で共通
+#
+#   classic:     1 ライン 10 点。名前なしはゲスト、同じ名前は入室できない
+#   stacksnatch: 同じ手番の中で消したライン数に応じたコンボ点 (n 本目は n * 10 点)。
+#                名前なしも "Player N" として記録し、同じ名前は "名前 2" のように付け直す
+#                (Stack & Snatch/main.py のルール)
+
+# 1 回の配置で消えるライン数と、1 手番で積み上がるコンボ数の上限 (表を作る範囲)
+MAX_LINES = 16
+MAX_COMBO = 64
+
+
+class Rules:
+    # id は操作ログとスナップショットに 1 バイトで記録する
+    id = 0
+    name = ""
+
+    def __init__(self):
+        # points[combo][lines] = (得点, 次のコンボ数)。得点計算は表を引くだけ
+        self.points = tuple(tuple(self._score(combo, lines) for lines in range(MAX_LINES + 1))
+                            for combo in range(MAX_COMBO + 1))
+
+    def score(self, lines: int, combo: int) -> tuple[int, int]:
+        if lines <= MAX_LINES and combo <= MAX_COMBO:
+            return self.points[combo][lines]
+        return self._score(combo, lines)
+
+    def _score(self, combo: int, lines: int) -> tuple[int, int]:
+        raise NotImplementedError
+
+    def player_name(self, input_name: str, player_id: int, taken) -> tuple[str, bool, bool]:
+        # (名前, ゲストか, 本人が入力した名前そのままか)。名前が使えない時は名前を None にする
+        # 自動で付けた・付け直した名前は別の人と同じになり得るので、全期間のランキングには記録しない
+        raise NotImplementedError
+
+    def is_game_over(self, turns_taken: int, player_count: int, max_rounds: int) -> bool:
+        # 今の手番が終わった時点でゲームを終えるか (turns_taken は今の手番を含まない)
+        raise NotImplementedError
+
+
+class ClassicRules(Rules):
+    id = 0
+    name = "classic"
+
+    def _score(self, combo, lines):
+        return lines * 10, combo
+
+    def player_name(self, input_name, player_id, taken):
+        if not input_name:
+            # 名前なし -> ゲスト扱い (Player N)
+            return f"Player {player_id}", True, False
+        if input_name in taken:
+            return None, False, False
+        return input_name, False, True
+
+    def is_game_over(self, turns_taken, player_count, max_rounds):
+        # 最終ラウンドの最後の人が操作を終えた瞬間に終了する
+        return turns_taken + 1 >= player_count * max_rounds
+
+
+class ComboRules(Rules):
+    id = 1
+    name = "stacksnatch"
+
+    def _score(self, combo, lines):
+        # 1 ライン消えるごとにコンボ数を増やして加算する
+        # 例: 既に 1 ライン消している手番で 2 ライン同時に消すと 20 + 30 = 50 点
+        return sum((combo + k) * 10 for k in range(1, lines + 1)), combo + lines
+
+    def player_name(self, input_name, player_id, taken):
+        base = input_name or f"Player {player_id}"
+        name = base
+        count = 2
+        while name in taken:
+            name = f"{base} {count}"
+            count += 1
+        return name, False, bool(input_name) and name == input_name
+
+    def is_game_over(self, turns_taken, player_count, max_rounds):
+        # 手番が終わった時点のラウンドが MAX_ROUNDS を超えていたら終了する
+        return player_count == 0 or turns_taken // player_count + 1 > max_rounds
+
+
+RULES = {rules.name: rules for rules in (ClassicRules(), ComboRules())}
+RULES_BY_ID = {rules.id: rules for rules in RULES.values()}
+DEFAULT_RULES = RULES["classic"]
+
+
+def rules_for(name: str) -> Rules:
+    # 知らない名前は既定のルールにする
+    return RULES.get(name, DEFAULT_RULES)
@@ -167,6 +167,101 @@ let prevSkipVotesLen = 0;
 let comboCount = 0;
 let lastClearTurnId = -1;
 let lastSentTime = 0;
+// サーバーの game_state (差分を重ねた最新の状態) と、その版番号
+let roomState = {};
+let stateSeq = null;
+// 観戦モード (読み取り専用。サーバーから間引かれた完全なフレームだけが届く)
+let isSpectator = false;
+// 再接続用: welcome で受け取ったトークンと、最後に受け取ったイベントの番号 (eseq)
+let sessionToken = null;
+let lastEventSeq = 0;
+// 送ったがまだサーバーから返ってきていない自分の配置 (再接続時に一度取り消す)
+let unconfirmed = [];
+// 自分で退出した・エラーで切られた時は再接続しない
+let leaving = false;
+let reconnectDelay = 1000;
+// バイナリ形式 (wire.py) を使うか。既定は JSON で、ページの URL に ?proto=bin を付けた時だけ使う
+const useBinary = new URLSearchParams(window.location.search).get('proto') === 'bin';
+
+// --- バイナリ形式 (wire.py と同じ並び) ---
+const STATE_FIELDS = ["count", "ranking", "current_turn", "turn_start_time", "skip_votes", "reset_votes",
+                      "host_id", "is_playing", "round_info", "is_clearing", "is_final", "hand"];
+const textDecoder = new TextDecoder();
+
+// 64bit のマスク (下位 32bit, 上位 32bit) の立っているマス番号
+function maskCells(lo, hi) {
+    const cells = [];
+    for (let i = 0; i < 32; i++) { if ((lo >>> i) & 1) cells.push(i); }
+    for (let i = 0; i < 32; i++) { if ((hi >>> i) & 1) cells.push(i + 32); }
+    return cells;
+}
+function voteIds(bits) { const ids = []; for (let i = 0; i < 16; i++) { if ((bits >> i) & 1) ids.push(i); } return ids; }
+
+function readState(view, offset, present, msg) {
+    STATE_FIELDS.forEach((name, bit) => {
+        if (!((present >> bit) & 1)) return;
+        switch (name) {
+            case "ranking": {
+                const n = view.getUint8(offset++); const ranking = [];
+                for (let i = 0; i < n; i++) {
+                    const id = view.getUint8(offset); const score = view.getInt32(offset + 1, true); const len = view.getUint8(offset + 5);
+                    offset += 6;
+                    ranking.push({id: id, name: textDecoder.decode(new Uint8Array(view.buffer, offset, len)), score: score});
+                    offset += len;
+                }
+                msg.ranking = ranking; break;
+            }
+            case "turn_start_time": msg[name] = view.getFloat64(offset, true); offset += 8; break;
+            case "skip_votes": case "reset_votes": msg[name] = voteIds(view.getUint16(offset, true)); offset += 2; break;
+            case "round_info": msg[name] = `${view.getUint32(offset, true)}/${view.getUint32(offset + 4, true)}`; offset += 8; break;
+            case "is_playing": case "is_clearing": case "is_final": msg[name] = view.getUint8(offset++) === 1; break;
+            case "hand": {
+                const n = view.getUint8(offset++); const hand = [];
+                for (let i = 0; i < n; i++) {
+                    const size = view.getUint8(offset); const bits = view.getUint32(offset + 1, true); offset += 5;
+                    if (size === 0) { hand.push(null); continue; }
+                    const h = size >> 4, w = size & 15; const shape = [];
+                    for (let r = 0; r < h; r++) { const row = []; for (let c = 0; c < w; c++) row.push((bits >>> (r * w + c)) & 1); shape.push(row); }
+                    hand.push(shape);
+                }
+                msg.hand = hand; break;
+            }
+            default: msg[name] = view.getUint8(offset++);
+        }
+    });
+    return msg;
+}
+
+function decodeFrame(buffer) {
+    const view = new DataView(buffer);
+    const kind = view.getUint8(0);
+    if (kind === 1) {
+        const updates = [];
+        maskCells(view.getUint32(13, true), view.getUint32(17, true)).forEach(i => updates.push({row: i >> 3, col: i & 7, value: 0}));
+        maskCells(view.getUint32(5, true), view.getUint32(9, true)).forEach(i => updates.push({row: i >> 3, col: i & 7, value: 1}));
+        return {type: "batch_update", eseq: view.getUint32(1, true), updates: updates};
+    }
+    if (kind === 2) {
+        const msg = {type: "game_state", seq: view.getUint32(1, true)};
+        if (view.getUint8(5) & 1) msg.full = true;
+        return readState(view, 8, view.getUint16(6, true), msg);
+    }
+    if (kind === 3) {
+        const rows = Array(BOARD_SIZE).fill(0).map(() => Array(BOARD_SIZE).fill(0));
+        maskCells(view.getUint32(1, true), view.getUint32(5, true)).forEach(i => rows[i >> 3][i & 7] = 1);
+        return readState(view, 11, view.getUint16(9, true), {type: "spectate", board: rows});
+    }
+    return {type: "unknown"};
+}
+
+// 置いた 1 手: u8 種別=1, u64 置いたマス
+function encodePlacement(updates) {
+    let lo = 0, hi = 0;
+    updates.forEach(u => { const i = u.row * BOARD_SIZE + u.col; if (i < 32) lo |= 1 << i; else hi |= 1 << (i - 32); });
+    const view = new DataView(new ArrayBuffer(9));
+    view.setUint8(0, 1); view.setUint32(1, lo >>> 0, true); view.setUint32(5, hi >>> 0, true);
+    return view.buffer;
+}
 
 function showModal(title, message, onConfirm, isConfirm = false) {
     const modal = document.getElementById('custom-modal');
@@ -184,41 +279,10 @@ function showModal(title, message, onConfirm, isConfirm = false) {
 function openRankingModal() { sound.playButton(); document.getElementById('ranking-modal').style.display = 'flex'; }
 function closeRankingModal(e) { if(e === null || e.target.id === 'ranking-modal') { sound.playButton(); document.getElementById('ranking-modal').style.display = 'none'; } }
 
-function getBlockSize(shape) { return shape.flat().filter(x => x === 1).length; }
-
-function refillHand() {
-    const placeable = SHAPES.filter(shape => isShapePlaceable(shape));
-    placeable.sort((a, b) => getBlockSize(b) - getBlockSize(a));
-    const newHand = [];
-    const source = placeable.length > 0 ? placeable : SHAPES;
-    for(let i=0; i<3; i++) {
-        const range = Math.max(1, Math.ceil(source.length * 0.5));
-        const pickIdx = Math.floor(Math.random() * range);
-        newHand.push(source[pickIdx]);
-    }
-    currentHand = newHand;
-}
-
-function isShapePlaceable(shape) {
-    for (let row = 0; row < BOARD_SIZE; row++) {
-        for (let col = 0; col < BOARD_SIZE; col++) {
-            if (canFit(shape, row, col)) return true;
-        }
-    }
-    return false;
-}
-
-function checkCanPlace() {
-    let hasBlocks = false;
-    for (let i = 0; i < currentHand.length; i++) {
-        const shape = currentHand[i];
-        if (shape === null) continue;
-        hasBlocks = true;
-        if (isShapePlaceable(shape)) return true; 
-        if (canPlaceAfterClear(shape)) return true;
-    }
-    if (!hasBlocks) return true; 
-    return false;
+// 手札はサーバーが配る (手番のプレイヤーの手札。使った枠は null)
+function setHand(hand) {
+    currentHand = [...hand];
+    if (draggingIdx !== -1 && currentHand[draggingIdx] === null) draggingIdx = -1;
 }
 function canFit(shape, startRow, startCol, targetBoard = board) {
     for (let r = 0; r < shape.length; r++) {
@@ -232,17 +296,6 @@ function canFit(shape, startRow, startCol, targetBoard = board) {
     }
     return true;
 }
-function canPlaceAfterClear(shapeToCheck) {
-    let simBoard = board.map(row => [...row]);
-    let rowsToClear = []; let colsToClear = [];
-    for (let r = 0; r < BOARD_SIZE; r++) { if (simBoard[r].every(cell => cell === 1)) rowsToClear.push(r); }
-    for (let c = 0; c < BOARD_SIZE; c++) { let full = true; for (let r = 0; r < BOARD_SIZE; r++) { if (simBoard[r][c] === 0) full = false; } if (full) colsToClear.push(c); }
-    if (rowsToClear.length === 0 && colsToClear.length === 0) return false;
-    rowsToClear.forEach(r => { for(let c=0; c<BOARD_SIZE; c++) simBoard[r][c] = 0; });
-    colsToClear.forEach(c => { for(let r=0; r<BOARD_SIZE; r++) simBoard[r][c] = 0; });
-    for (let r = 0; r < BOARD_SIZE; r++) { for (let c = 0; c < BOARD_SIZE; c++) { if (canFit(shapeToCheck, r, c, simBoard)) return true; } }
-    return false;
-}
 function checkPotentialClears(shape, startRow, startCol) {
     let tempBoard = board.map(row => [...row]);
     for(let r=0; r<shape.length; r++) {
@@ -258,44 +311,60 @@ function checkPotentialClears(shape, startRow, startCol) {
     return { rows, cols };
 }
 
-async function triggerAutoPass() {
+// 置ける手札がないとサーバーが判断してパスした (表示だけ)
+async function showAutoPass() {
     const overlay = document.getElementById('pass-overlay');
     overlay.classList.add('active');
     document.getElementById('gameCanvas').classList.add('inactive-canvas');
-    currentHand = [null, null, null];
     await new Promise(r => setTimeout(r, 2000));
-    ws.send(JSON.stringify({type: 'pass_turn'}));
     overlay.classList.remove('active');
 }
 
 // --- 通信関連 ---
-function startGame() {
-    sound.playButton();
+function startGame(spectate = false, resume = false) {
+    if (!resume) sound.playButton();
     const roomInput = document.getElementById('roomInput').value.trim();
     const nameInput = document.getElementById('nameInput').value.trim();
     if (!roomInput) { document.getElementById('error-msg').innerText = "合言葉を入力してください"; return; }
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const host = window.location.host;
-    const url = `${protocol}//${host}/ws/${encodeURIComponent(roomInput)}?nickname=${encodeURIComponent(nameInput)}`;
+    isSpectator = spectate;
+    // ルールの種類はページの URL (?variant=stacksnatch) で選ぶ。新しく部屋を作る時だけ効く
+    const variant = new URLSearchParams(window.location.search).get('variant');
+    const url = `${protocol}//${host}/ws/${encodeURIComponent(roomInput)}?nickname=${encodeURIComponent(nameInput)}`
+        + (spectate ? '&spectate=1' : '') + (variant ? `&variant=${encodeURIComponent(variant)}` : '')
+        + (useBinary ? '&proto=bin' : '')
+        + (resume ? `&session=${encodeURIComponent(sessionToken)}&last_seq=${lastEventSeq}` : '');
     
-    if (ws) ws.close();
+    if (ws) { ws.onclose = null; ws.close(); }
+    // 新しい接続では完全な game_state が届くまで差分を使わない
+    stateSeq = null;
     ws = new WebSocket(url);
+    ws.binaryType = 'arraybuffer';
 
     ws.onopen = function() {
         document.getElementById('title-screen').style.display = 'none';
         document.getElementById('game-container').style.display = 'flex';
         document.getElementById('room-info').innerText = `Room: ${roomInput.toUpperCase()}`;
-        if(currentHand.length === 0 || currentHand.every(s=>s===null)) refillHand();
+        if (isSpectator) {
+            document.getElementById('player-badge').innerText = 'SPECTATOR';
+            document.getElementById('action-skip-btn').style.display = 'none';
+            document.getElementById('reset-btn').style.display = 'none';
+        }
         draw();
         if(timerInterval) clearInterval(timerInterval);
         timerInterval = setInterval(checkTurnTimer, 1000);
     };
 
     ws.onmessage = function(event) {
-        const data = JSON.parse(event.data);
-        if (data.type === "error") showModal("ERROR", data.message, () => location.reload());
+        const data = (typeof event.data === 'string') ? JSON.parse(event.data) : decodeFrame(event.data);
+        if (data.eseq !== undefined) lastEventSeq = data.eseq;
+        if (data.type === "error") { leaving = true; showModal("ERROR", data.message, () => location.reload()); }
         else if (data.type === "welcome") {
             myPlayerId = data.your_id;
+            sessionToken = data.session;
+            lastEventSeq = data.event_seq;
+            reconnectDelay = 1000;
             document.getElementById('player-badge').innerText = `${data.your_name} (YOU)`;
             
             const overlay = document.getElementById('setup-overlay');
@@ -314,44 +383,38 @@ function startGame() {
                 }
             }
 
-            if(data.restored) showModal("WELCOME BACK", "スコアを復元しました！");
-            updateBoard(data.board);
-            if(currentHand.length === 0 || currentHand.every(s=>s===null)) refillHand();
+            if(data.restored && !data.resumed) showModal("WELCOME BACK", "スコアを復元しました！");
+            if (data.board) {
+                updateBoard(data.board);
+            } else {
+                // 抜けていたイベントだけが続けて届く: 確定していない自分の配置を取り消してから重ねる
+                unconfirmed.forEach(u => board[u.row][u.col] = 0);
+            }
+            unconfirmed = [];
         }
         else if (data.type === "game_start") {
             if(document.getElementById('setup-overlay')) 
                 document.getElementById('setup-overlay').style.display = 'none';
         }
         else if (data.type === "game_state") {
-            document.getElementById('online-count').innerText = `ONLINE: ${data.count}/10`;
-            totalPlayers = data.count;
-            currentTurnId = data.current_turn;
-            turnStartTime = data.turn_start_time;
-            currentSkipVotes = data.skip_votes;
-            currentResetVotes = data.reset_votes;
-            hostId = data.host_id;
-            isClearing = data.is_clearing;
-            
-            const roundText = document.getElementById('turn-count-info');
-            roundText.innerText = `Round: ${data.round_info}`;
-            if(data.is_final) roundText.classList.add('final-round');
-            else roundText.classList.remove('final-round');
-            
-            updateTurnDisplay(data.ranking);
-            updateRanking(data.ranking);
-            updateButtons();
-            updateVotePopup();
-            
-            if (currentHand.length === 0 || currentHand.every(s => s === null)) {
-                refillHand();
-            }
-            
-            if (currentTurnId === myPlayerId && !isClearing && isPlaying) {
-                if (!checkCanPlace()) triggerAutoPass();
+            if (data.full) {
+                roomState = data;
+            } else if (stateSeq === null) {
+                return; // 入室直後: 完全なスナップショットを待つ
+            } else if (data.seq !== stateSeq + 1) {
+                // 欠落を検出: スナップショットを要求して、届くまで差分は捨てる
+                stateSeq = null;
+                ws.send(JSON.stringify({type: 'sync_state'}));
+                return;
+            } else {
+                Object.assign(roomState, data);
             }
-            isPlaying = data.is_playing; 
+            stateSeq = data.seq;
+            if ('hand' in data) setHand(data.hand);
+            applyRoomState(roomState);
         }
         else if (data.type === "batch_update") {
+            unconfirmed = unconfirmed.filter(u => !data.updates.some(item => item.row === u.row && item.col === u.col));
             let cleared = false;
             data.updates.forEach(item => {
                 if (item.value === 0 && board[item.row][item.col] === 1) {
@@ -370,16 +433,68 @@ function startGame() {
                 comboCount = 0; 
             }
         }
+        else if (data.type === "spectate") {
+            updateBoard(data.board);
+            roomState = data;
+            setHand(data.hand);
+            applyRoomState(roomState);
+        }
+        else if (data.type === "move_rejected") {
+            // サーバーが置き方を受け付けなかった: 先に書き換えた盤面と手札を戻す
+            unconfirmed = [];
+            updateBoard(data.board);
+            setHand(data.hand);
+        }
         else if (data.type === "init") {
             updateBoard(data.board);
-            refillHand();
             showModal("RESET", "Game has been reset!", null);
         }
         else if (data.type === "game_over") {
             showGameOver(data.ranking);
         }
+        else if (data.type === "turn_timeout") {
+            // サーバー側の時間切れ: 手札は次の手番のプレイヤーに配り直される
+            if (data.player_id === myPlayerId) draggingIdx = -1;
+        }
+        else if (data.type === "auto_pass") {
+            if (data.player_id === myPlayerId) { draggingIdx = -1; showAutoPass(); }
+        }
     };
-    ws.onclose = function() { if(timerInterval) clearInterval(timerInterval); };
+    ws.onclose = function() {
+        if(timerInterval) clearInterval(timerInterval);
+        // 意図しない切断: トークンと最後のイベント番号を付けて入り直す (抜けていた分だけが届く)
+        if (!leaving && sessionToken && !isSpectator) {
+            setTimeout(() => { if (!leaving) startGame(false, true); }, reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, 8000);
+        }
+    };
+}
+
+function applyRoomState(data) {
+    document.getElementById('online-count').innerText = `ONLINE: ${data.count}/10`;
+    totalPlayers = data.count;
+    currentTurnId = data.current_turn;
+    turnStartTime = data.turn_start_time;
+    currentSkipVotes = data.skip_votes;
+    currentResetVotes = data.reset_votes;
+    hostId = data.host_id;
+    isClearing = data.is_clearing;
+    
+    const roundText = document.getElementById('turn-count-info');
+    roundText.innerText = `Round: ${data.round_info}`;
+    if(data.is_final) roundText.classList.add('final-round');
+    else roundText.classList.remove('final-round');
+    
+    updateTurnDisplay(data.ranking);
+    updateRanking(data.ranking);
+    updateButtons();
+    updateVotePopup();
+    isPlaying = data.is_playing;
+}
+
+function addBot() {
+    sound.playButton();
+    ws.send(JSON.stringify({type: 'add_bot'}));
 }
 
 function sendGameStart() {
@@ -441,7 +556,6 @@ function handleSkipAction() {
 
 function manualPass() {
     showModal("SKIP TURN", "本当にスキップしますか？", () => {
-        currentHand = [null, null, null];
         ws.send(JSON.stringify({type: 'pass_turn'}));
     }, true);
 }
@@ -503,7 +617,7 @@ function updateVotePopup() {
 window.voteReset = function() { sound.playButton(); ws.send(JSON.stringify({type: 'vote_reset'})); };
 window.voteSkip = function() { sound.playButton(); ws.send(JSON.stringify({type: 'vote_skip'})); };
 window.vetoSkip = function() { sound.playButton(); ws.send(JSON.stringify({type: 'veto_skip'})); };
-window.handleExit = function() { showModal("EXIT", "退出しますか？", () => { if (ws) { ws.close(); ws = null; } location.reload(); }, true); };
+window.handleExit = function() { showModal("EXIT", "退出しますか？", () => { leaving = true; if (ws) { ws.close(); ws = null; } location.reload(); }, true); };
 function kickPlayer(targetId) { if(confirm("Kick this player?")) ws.send(JSON.stringify({type: 'kick_player', target_id: targetId})); }
 function openRankingModal() { sound.playButton(); document.getElementById('ranking-modal').style.display = 'flex'; }
 function closeRankingModal(e) { if(e === null || e.target.id === 'ranking-modal') { sound.playButton(); document.getElementById('ranking-modal').style.display = 'none'; } }
@@ -634,7 +748,7 @@ function drawShape(shape, startX, startY, size, color, gloss) {
 function getCanvasCoordinates(event) { const rect = canvas.getBoundingClientRect(); let clientX, clientY; if (event.touches && event.touches.length > 0) { clientX = event.touches[0].clientX; clientY = event.touches[0].clientY; } else { clientX = event.clientX; clientY = event.clientY; } const scaleX = canvas.width / rect.width; const scaleY = canvas.height / rect.height; return { x: (clientX - rect.left) * scaleX, y: (clientY - rect.top) * scaleY }; }
 
 function handleStart(e) {
-    if (currentTurnId !== myPlayerId || isClearing) return;
+    if (isSpectator || currentTurnId !== myPlayerId || isClearing) return;
     if(e.type === 'touchstart') e.preventDefault();
     sound.playPick();
     const pos = getCanvasCoordinates(e);
@@ -670,10 +784,10 @@ function handleEnd(e) {
             sound.playPlace();
             const updates = [];
             for(let r=0; r<shape.length; r++) { for(let c=0; c<shape[r].length; c++) { if(shape[r][c] === 1) { const tR = placeRow + r; const tC = placeCol + c; board[tR][tC] = 1; updates.push({row: tR, col: tC, value: 1}); } } }
-            ws.send(JSON.stringify({type: 'batch_update', updates: updates}));
+            ws.send(useBinary ? encodePlacement(updates) : JSON.stringify({type: 'batch_update', updates: updates}));
+            unconfirmed = unconfirmed.concat(updates);
+            // 手札を使い切った時の手番の終了と、置けない時の自動パスはサーバーが決める
             currentHand[draggingIdx] = null;
-            if (currentHand.every(s => s === null)) { refillHand(); ws.send(JSON.stringify({type: 'end_turn'})); }
-            else { if (!checkCanPlace()) { triggerAutoPass(); } }
         } else {
             sound.playReturn();
         }
@@ -682,8 +796,6 @@ function handleEnd(e) {
 }
 canvas.addEventListener('mousedown', handleStart); canvas.addEventListener('mousemove', handleMove); canvas.addEventListener('mouseup', handleEnd); canvas.addEventListener('touchstart', handleStart, {passive: false}); canvas.addEventListener('touchmove', handleMove, {passive: false}); canvas.addEventListener('touchend', handleEnd, {passive: false});
 
-// ★初期化時にも手札を作る
-if(currentHand.length === 0) refillHand();
 // 入力フォームの効果音
 const roomInput = document.getElementById('roomInput');
 const nameInput = document.getElementById('nameInput');
@@ -0,0 +1,83 @@
+# bot 同士の対戦をサーバーなしで回し、ルール・得点・評価の重みを調べる
+# 手札の配り方・置き方の判定・得点はサーバーと同じもの (shapes / engine / rules) を使う
+#
+#   python selfplay.py --games 20 --players 2 --rounds 10 [--variant stacksnatch] [--workers 4]
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+from rules import rules_for
+from shapes import PlacementIndex, deal_hand
+
+
+def play_game(seed: int, players: int, rounds: int, variant: str, budget: float) -> dict:
+    # 1 ゲーム分。手番ごとに配った手札を、エンジンの答えの順に置く
+    rng = random.Random(seed)
+    rules = rules_for(variant)
+    index = PlacementIndex()
+    board = 0
+    scores = [0] * players
+    placements = 0
+    passes = 0
+    turns = 0
+    while True:
+        player = turns % players
+        hand = deal_hand(rng, index)
+        combo = 0
+        moves = engine.plan(board, hand, 0, rules.name, budget)
+        for mask in moves:
+            board, lines = engine.place(board, mask)
+            if lines:
+                points, combo = rules.score(lines, combo)
+                scores[player] += points
+            placements += 1
+        if len(moves) < len(hand):
+            passes += 1
+        index.update(board)
+        if rules.is_game_over(turns, players, rounds):
+            break
+        turns += 1
+    return {"scores": scores, "placements": placements, "passes": passes, "turns": turns + 1}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--variant", default="classic")
+    parser.add_argument("--budget", type=float, default=0.01, help="1 手番あたりの思考時間 (秒)")
+    parser.add_argument("--workers", type=int, default=1, help="並列に回すプロセス数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    jobs = [(args.seed + i, args.players, args.rounds, args.variant, args.budget) for i in range(args.games)]
+    started = time.perf_counter()
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers) as pool:
+            results = list(pool.map(play_game, *zip(*jobs)))
+    else:
+        results = [play_game(*job) for job in jobs]
+    elapsed = time.perf_counter() - started
+
+    placements = sum(r["placements"] for r in results)
+    scores = [score for r in results for score in r["scores"]]
+    print(json.dumps({
+        "config": {"games": args.games, "players": args.players, "rounds": args.rounds,
+                   "variant": rules_for(args.variant).name, "budget": args.budget, "workers": args.workers},
+        "elapsed_sec": round(elapsed, 3),
+        "games_per_sec": round(len(results) / elapsed, 3),
+        "placements_per_sec": round(placements / elapsed, 1),
+        "placements": placements,
+        "passes": sum(r["passes"] for r in results),
+        "turns": sum(r["turns"] for r in results),
+        "score_mean": round(sum(scores) / len(scores), 1) if scores else None,
+        "score_max": max(scores, default=None),
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
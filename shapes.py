@@ -0,0 +1,150 @@
+# ピースの形と、盤面上の全ての置き方のビットマスク (起動時に 1 回だけ作る)
+# SHAPES は script.js と同じもの (向きごとに別の形。重複はここで除く)
+import math
+
+from bitboard import BOARD_SIZE
+
+SHAPES = [
+    [[1]], [[1, 1]], [[1], [1]], [[1, 1, 1]], [[1], [1], [1]],
+    [[1, 1, 1, 1]], [[1], [1], [1], [1]], [[1, 1, 1, 1, 1]], [[1], [1], [1], [1], [1]],
+    [[1, 1], [1, 1]], [[1, 1, 1], [1, 1, 1], [1, 1, 1]],
+    [[1, 0], [1, 1]], [[0, 1], [1, 1]], [[1, 1], [1, 0]], [[1, 1], [0, 1]],
+    [[1, 0], [1, 0], [1, 1]], [[0, 1], [0, 1], [1, 1]],
+    [[1, 1, 1], [1, 0, 0]], [[1, 0, 0], [1, 1, 1]],
+    [[1, 1], [1, 0], [1, 0]], [[1, 1], [0, 1], [0, 1]],
+    [[0, 0, 1], [1, 1, 1]], [[1, 1, 1], [0, 0, 1]],
+    [[1, 1, 1], [0, 1, 0]], [[0, 1, 0], [1, 1, 1]],
+    [[1, 0], [1, 1], [1, 0]], [[0, 1], [1, 1], [0, 1]],
+    [[1, 1, 0], [0, 1, 1]], [[0, 1, 1], [1, 1, 0]],
+    [[0, 1], [1, 1], [1, 0]], [[1, 0], [1, 1], [0, 1]],
+    [[1, 0], [0, 1]], [[0, 1], [1, 0]],
+    [[1, 1, 1], [1, 0, 0], [1, 0, 0]], [[1, 1, 1], [0, 0, 1], [0, 0, 1]],
+    [[0, 0, 1], [0, 0, 1], [1, 1, 1]], [[1, 0, 0], [1, 0, 0], [1, 1, 1]],
+    [[1, 0], [0, 1]], [[0, 1], [1, 0]],
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]], [[0, 0, 1], [0, 1, 0], [1, 0, 0]],
+    [[0, 1, 0], [1, 1, 1], [0, 1, 0]],
+    [[1, 0, 1], [1, 1, 1]], [[1, 1, 1], [1, 0, 1]],
+    [[1, 1], [1, 0], [1, 1]], [[1, 1], [0, 1], [1, 1]],
+]
+
+
+def _shape_placements(shape: list[list[int]]) -> tuple[int, ...]:
+    # 左上を (0, 0) に置いた時のマスクを、はみ出さない範囲でずらしたもの全部
+    base = 0
+    for r, row in enumerate(shape):
+        for c, v in enumerate(row):
+            if v:
+                base |= 1 << (r * BOARD_SIZE + c)
+    height, width = len(shape), len(shape[0])
+    return tuple(base << (r * BOARD_SIZE + c)
+                 for r in range(BOARD_SIZE - height + 1) for c in range(BOARD_SIZE - width + 1))
+
+
+def _cells(shape: list[list[int]]) -> int:
+    return sum(map(sum, shape))
+
+
+_unique = {}
+for _shape in SHAPES:
+    _unique.setdefault(repr(_shape), _shape)
+# 大きい順 (同じ大きさなら SHAPES の順)。手札を配る時に並べ替えなくて済む
+UNIQUE_SHAPES = sorted(_unique.values(), key=_cells, reverse=True)
+del _unique, _shape
+
+# SHAPE_PLACEMENTS[i] = UNIQUE_SHAPES[i] の全ての置き方
+SHAPE_PLACEMENTS = [_shape_placements(shape) for shape in UNIQUE_SHAPES]
+# 正しい 1 手のマスク -> 形の番号 (形が違えば置き方のマスクも違う)
+PLACEMENTS = {mask: shape for shape, masks in enumerate(SHAPE_PLACEMENTS) for mask in masks}
+MAX_CELLS = max(map(_cells, UNIQUE_SHAPES))
+
+# 置き方の通し番号。置き方の集合は通し番号のビット列 (Python の int) で表す
+ALL_PLACEMENTS = [mask for masks in SHAPE_PLACEMENTS for mask in masks]
+ALL_BITS = (1 << len(ALL_PLACEMENTS)) - 1
+# 形ごとの通し番号の範囲
+SHAPE_BITS = []
+_start = 0
+for _masks in SHAPE_PLACEMENTS:
+    SHAPE_BITS.append(((1 << len(_masks)) - 1) << _start)
+    _start += len(_masks)
+del _start, _masks
+# マスごとに、そのマスを使う置き方
+CELL_COVER = [sum(1 << i for i, mask in enumerate(ALL_PLACEMENTS) if mask >> cell & 1)
+              for cell in range(BOARD_SIZE * BOARD_SIZE)]
+
+
+def placement_mask(updates) -> int:
+    # batch_update の updates を 1 手分のマスクにする。置き方として正しくなければ 0
+    if not isinstance(updates, list) or not 0 < len(updates) <= MAX_CELLS:
+        return 0
+    mask = 0
+    for item in updates:
+        try:
+            r, c, v = item["row"], item["col"], item["value"]
+        except (TypeError, KeyError):
+            return 0
+        if v != 1 or type(r) is not int or type(c) is not int or not (0 <= r < BOARD_SIZE and 0 <= c < BOARD_SIZE):
+            return 0
+        mask |= 1 << (r * BOARD_SIZE + c)
+    return mask if mask in PLACEMENTS else 0
+
+
+def is_legal(mask: int, board: int) -> bool:
+    return mask in PLACEMENTS and mask & board == 0
+
+
+def _cover(mask: int) -> int:
+    covered = 0
+    while mask:
+        low = mask & -mask
+        covered |= CELL_COVER[low.bit_length() - 1]
+        mask ^= low
+    return covered
+
+
+class PlacementIndex:
+    # 今の盤面で置ける置き方の集合。盤面が変わったら、変わったマスを使う置き方だけを見直す
+    __slots__ = ("board", "legal")
+
+    def __init__(self, board: int = 0):
+        self.board = 0
+        self.legal = ALL_BITS
+        self.update(board)
+
+    def update(self, board: int):
+        filled = board & ~self.board
+        emptied = self.board & ~board
+        self.board = board
+        if filled:
+            # 埋まったマスを使う置き方は全部置けなくなる
+            self.legal &= ~_cover(filled)
+        if emptied:
+            # 空いたマスを使う置き方のうち、他のマスも空いているものだけが置けるようになる
+            candidates = _cover(emptied) & ~self.legal
+            while candidates:
+                low = candidates & -candidates
+                if not ALL_PLACEMENTS[low.bit_length() - 1] & board:
+                    self.legal |= low
+                candidates ^= low
+
+    def placeable(self, shape: int) -> bool:
+        return self.legal & SHAPE_BITS[shape] != 0
+
+    def placeable_shapes(self) -> list[int]:
+        legal = self.legal
+        return [shape for shape, bits in enumerate(SHAPE_BITS) if legal & bits]
+
+
+def deal_hand(rng, index: PlacementIndex, size: int = 3) -> list[int]:
+    # script.js の refillHand と同じ配り方: 置ける形のうち大きい方の半分から選ぶ (置ける形がなければ全部から)
+    source = index.placeable_shapes() or list(range(len(UNIQUE_SHAPES)))
+    top = max(1, math.ceil(len(source) * 0.5))
+    return [source[rng.randrange(top)] for _ in range(size)]
+
+
+def pack_hand(hand: list) -> int:
+    # 操作ログ用: 1 枚 1 バイト (形の番号 + 1、使用済みは 0)
+    packed = 0
+    for i, shape in enumerate(hand):
+        if shape is not None:
+            packed |= (shape + 1) << (i * 8)
+    return packed
@@ -0,0 +1,185 @@
+# 複数プロセスで部屋を分担する (シャーディング)
+# room_id をハッシュして担当ワーカーを決め、前段のルーターが /ws/{room_id} をそのワーカーへ中継する
+#
+#   python shard.py --shards 4 --port 8000
+#
+# ワーカーは 127.0.0.1 の base-port, base-port+1, ... で起動する
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.responses import PlainTextResponse, Response
+from urllib.parse import quote
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import urllib.request
+
+from metrics import merge_shards
+
+SHARD_HOST = os.environ.get("SHARD_HOST", "127.0.0.1")
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", "9000"))
+
+
+def shard_for(room_id: str, shard_count: int) -> int:
+    # ランデブーハッシュ: シャード数が変わっても移動する部屋は最小限で済む
+    if shard_count <= 1:
+        return 0
+    best, best_score = 0, b""
+    key = room_id.encode()
+    for shard in range(shard_count):
+        score = hashlib.blake2b(key, digest_size=8, salt=shard.to_bytes(8, "little")).digest()
+        if score > best_score:
+            best, best_score = shard, score
+    return best
+
+
+def _fetch(url: str) -> bytes:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return response.read()
+
+
+async def fetch_shards(path: str, shards) -> list[tuple[int, bytes]]:
+    # 各ワーカーの HTTP API を読む (応答しないワーカーは飛ばす)
+    async def one(shard):
+        try:
+            return shard, await asyncio.to_thread(_fetch, f"http://{SHARD_HOST}:{SHARD_BASE_PORT + shard}{path}")
+        except Exception:
+            return shard, None
+    results = await asyncio.gather(*(one(shard) for shard in shards))
+    return [(shard, body) for shard, body in results if body is not None]
+
+
+def forwardable(code: int) -> int:
+    # 1005 / 1006 / 1015 は close フレームで送れない (実際の切断がなかったことを表す) ので通常の終了にする
+    if code is None or code in (1005, 1006, 1015):
+        return 1000
+    return code
+
+
+def sum_stats(items: list[dict]) -> dict:
+    # /stats の数値をワーカー全体で足し合わせる (入れ子の dict も同じように)
+    total = {}
+    for item in items:
+        for key, value in item.items():
+            if isinstance(value, dict):
+                total[key] = sum_stats([total.get(key, {}), value])
+            elif isinstance(value, (int, float)):
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def create_router(shard_count: int) -> FastAPI:
+    import websockets
+    import main
+
+    router = FastAPI()
+
+    @router.websocket("/ws/{room_id}")
+    async def route_websocket(websocket: WebSocket, room_id: str):
+        shard = shard_for(room_id, shard_count)
+        url = f"ws://{SHARD_HOST}:{SHARD_BASE_PORT + shard}/ws/{quote(room_id, safe='')}"
+        if websocket.url.query:
+            url += "?" + websocket.url.query
+
+        await websocket.accept()
+        try:
+            upstream = await websockets.connect(url, max_size=None)
+        except Exception:
+            await websocket.send_json({"type": "error", "message": "サーバーに接続できません"})
+            await websocket.close()
+            return
+
+        # 切断の理由 (close code) は反対側にもそのまま伝える。特にルーターの再起動による 1012 を
+        # ワーカーが通常の退出と区別できないと、進行中のゲームが手番を進められスナップショットも消される
+        codes = {"client": None, "upstream": None}
+
+        async def client_to_upstream():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    codes["client"] = message.get("code")
+                    return
+                if message.get("text") is not None:
+                    await upstream.send(message["text"])
+                elif message.get("bytes") is not None:
+                    await upstream.send(message["bytes"])
+
+        async def upstream_to_client():
+            try:
+                async for data in upstream:
+                    if isinstance(data, str):
+                        await websocket.send_text(data)
+                    else:
+                        await websocket.send_bytes(data)
+            except websockets.ConnectionClosed:
+                pass
+            codes["upstream"] = upstream.close_code
+
+        tasks = [asyncio.create_task(client_to_upstream()), asyncio.create_task(upstream_to_client())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await upstream.close(code=forwardable(codes["client"]))
+            try:
+                await websocket.close(code=forwardable(codes["upstream"]))
+            except Exception:
+                pass
+
+    # 部屋の状態とランキングのキャッシュはワーカーにある (マウントした main.app の lifespan はルーターでは動かない)
+    @router.get("/stats")
+    async def route_stats():
+        return sum_stats([json.loads(body) for _, body in await fetch_shards("/stats", range(shard_count))])
+
+    @router.get("/metrics")
+    async def route_metrics():
+        texts = [(shard, body.decode()) for shard, body in await fetch_shards("/metrics", range(shard_count))]
+        return PlainTextResponse(merge_shards(texts), media_type="text/plain; version=0.0.4")
+
+    @router.get("/leaderboard")
+    async def route_leaderboard(request: Request):
+        # 全ワーカーが同じ SQLite を読むので、応答した最初のワーカーの結果を返す
+        path = "/leaderboard" + ("?" + request.url.query if request.url.query else "")
+        for shard in range(shard_count):
+            results = await fetch_shards(path, [shard])
+            if results:
+                return Response(results[0][1], media_type="application/json")
+        return {"entries": []}
+
+    # 静的ファイルなど /ws 以外はルーター自身が返す
+    router.mount("/", main.app)
+    return router
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=int(os.environ.get("SHARD_COUNT", "2")))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    workers = []
+    for shard in range(args.shards):
+        env = dict(os.environ, SHARD_INDEX=str(shard), SHARD_COUNT=str(args.shards))
+        workers.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app",
+             "--host", SHARD_HOST, "--port", str(SHARD_BASE_PORT + shard)],
+            cwd=base_dir, env=env))
+
+    try:
+        uvicorn.run(create_router(args.shards), host=args.host, port=args.port)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,106 @@
+# 部屋の状態をディスクに保存し、再起動後に復元する
+# 1 部屋 1 ファイルの小さなバイナリ形式。書き込みは専用スレッドで行い、イベントループを止めない
+from concurrent.futures import ThreadPoolExecutor, Future
+import hashlib
+import os
+import struct
+
+SNAPSHOT_MAGIC = b"BBS2"
+# magic, 盤面, MAX_ROUNDS, 総ターン数, プレイ中か, プレイヤー数, ルールの id
+_HEADER = struct.Struct("<4sQIIBHB")
+# ルールの id がない前の版 (読み込みだけ対応する)
+_MAGIC_V1 = b"BBS1"
+_HEADER_V1 = struct.Struct("<4sQIIBH")
+# スコア, ホストだったか, 名前のバイト数
+_PLAYER = struct.Struct("<iBH")
+
+
+def encode_room(room) -> bytes:
+    # 接続中の (ゲスト以外の) プレイヤーも「切断中」として保存する: 再接続すれば名前で復元される
+    # ゲストの再接続データはトークンでしか取り出せないので保存しない (トークンは再起動で無効になる)
+    players = {name: data for name, data in room.disconnected_data.items() if not data.get('guest')}
+    table = room.players
+    for pid in table.ids():
+        if table.is_guest(pid):
+            continue
+        players[table.names[pid]] = {'score': table.scores[pid], 'was_host': room.host_id == pid}
+
+    parts = [_HEADER.pack(SNAPSHOT_MAGIC, room.board.bits, room.MAX_ROUNDS, room.total_turns_taken,
+                          int(room.is_playing), len(players), room.rules.id)]
+    for name, data in players.items():
+        raw = name.encode()
+        parts.append(_PLAYER.pack(data['score'], int(data['was_host']), len(raw)))
+        parts.append(raw)
+    return b"".join(parts)
+
+
+def decode_room(data: bytes) -> dict:
+    if data[:4] == _MAGIC_V1:
+        _, bits, max_rounds, total_turns, is_playing, count = _HEADER_V1.unpack_from(data, 0)
+        variant = 0
+        offset = _HEADER_V1.size
+    else:
+        magic, bits, max_rounds, total_turns, is_playing, count, variant = _HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a room snapshot")
+        offset = _HEADER.size
+    players = {}
+    for _ in range(count):
+        score, was_host, length = _PLAYER.unpack_from(data, offset)
+        offset += _PLAYER.size
+        name = data[offset:offset + length].decode()
+        offset += length
+        players[name] = {'score': score, 'was_host': bool(was_host)}
+    return {
+        "board": bits,
+        "max_rounds": max_rounds,
+        "total_turns_taken": total_turns,
+        "is_playing": bool(is_playing),
+        "variant": variant,
+        "players": players,
+    }
+
+
+class SnapshotStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        # 1 スレッドだけにして、同じ部屋への保存・削除・読み込みの順序を保つ
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+    def path_for(self, room_id: str) -> str:
+        # room_id は任意の文字列なのでハッシュをファイル名にする
+        digest = hashlib.sha1(room_id.encode()).hexdigest()
+        return os.path.join(self.directory, digest + ".snap")
+
+    def save(self, room_id: str, data: bytes) -> Future:
+        return self.executor.submit(self._write, self.path_for(room_id), data)
+
+    def delete(self, room_id: str) -> Future:
+        return self.executor.submit(self._remove, self.path_for(room_id))
+
+    def load(self, room_id: str) -> Future:
+        return self.executor.submit(self._read, self.path_for(room_id))
+
+    def flush(self):
+        # 溜まっている書き込みが全部終わるまで待つ
+        self.executor.submit(lambda: None).result()
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _read(self, path: str):
+        try:
+            with open(path, "rb") as f:
+                return decode_room(f.read())
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,95 @@
+# 全部屋で共有する階層型タイマーホイール
+# 登録・取り消しは O(1)。部屋ごとにタスクや sleep を持たず、1 つのタスクが tick ごとに進める
+import asyncio
+import traceback
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "slot")
+
+    def __init__(self, deadline: int, callback, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.slot: set = None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 0.1, levels: int = 4):
+        self.tick = tick
+        self.levels = levels
+        self.now_tick = 0
+        # wheels[level][slot] = そのスロットで期限を迎える (または下の段に降りる) タイマー
+        self.wheels = [[set() for _ in range(SLOTS)] for _ in range(levels)]
+        self._origin: float = None
+
+    def __len__(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        ticks = max(1, int(delay / self.tick + 0.5))
+        timer = Timer(self.now_tick + ticks, callback, args)
+        self._place(timer)
+        return timer
+
+    def _place(self, timer: Timer):
+        delta = timer.deadline - self.now_tick
+        level = 0
+        while level < self.levels - 1 and delta >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        slot = self.wheels[level][(timer.deadline >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot.add(timer)
+        timer.slot = slot
+
+    def step(self):
+        # 1 tick 進める: 上の段の該当スロットを下に降ろしてから、0 段目の期限切れを実行する
+        self.now_tick += 1
+        now = self.now_tick
+        top = 0
+        while top < self.levels - 1 and not now & ((1 << (SLOT_BITS * (top + 1))) - 1):
+            top += 1
+        # 上の段から順に降ろす (降ろした先のスロットがこれから処理されるように)
+        for level in range(top, 0, -1):
+            slot = self.wheels[level][(now >> (SLOT_BITS * level)) & SLOT_MASK]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+
+        slot = self.wheels[0][now & SLOT_MASK]
+        if not slot:
+            return
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            if timer.deadline > now:
+                # 範囲外だったタイマーがまだ早い場合は置き直す
+                self._place(timer)
+                continue
+            timer.slot = None
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                traceback.print_exc()
+
+    def advance_to(self, now: float):
+        target = int((now - self._origin) / self.tick)
+        while self.now_tick < target:
+            self.step()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # 止まっていた間の tick は進めない (再開時点から数える)
+        self._origin = loop.time() - self.now_tick * self.tick
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance_to(loop.time())
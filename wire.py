@@ -0,0 +1,137 @@
+# 接続ごとに選べるバイナリ形式 (/ws/{room_id}?proto=bin)。既定は JSON のまま
+# 頻度の高いフレーム (盤面の差分・game_state・観戦フレーム) だけをバイナリにし、それ以外は JSON で送る
+#
+#   盤面の差分   u8 種別=1, u32 eseq, u64 1 にするマス, u64 0 にするマス
+#   game_state   u8 種別=2, u32 seq, u8 フラグ (bit0: full), u16 含まれるフィールド, フィールド...
+#   観戦フレーム u8 種別=3, u64 盤面, game_state と同じフィールド (全部)
+#
+# クライアントからは置いた 1 手だけをバイナリで送る: u8 種別=1, u64 置いたマス
+import struct
+
+from bitboard import BOARD_SIZE, updates_to_masks
+
+MSG_BOARD = 1
+MSG_STATE = 2
+MSG_SPECTATE = 3
+
+# クライアントから
+MSG_PLACE = 1
+
+_BOARD = struct.Struct("<BIQQ")
+_STATE_HEAD = struct.Struct("<BIBH")
+_SPECTATE_HEAD = struct.Struct("<BQH")
+_PLACE = struct.Struct("<BQ")
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_F64 = struct.Struct("<d")
+_ROUNDS = struct.Struct("<II")
+_RANK = struct.Struct("<BiB")
+_PIECE = struct.Struct("<BI")
+
+# game_state のフィールドの順番 (ビット位置)。script.js の STATE_FIELDS と同じ順
+STATE_FIELDS = ("count", "ranking", "current_turn", "turn_start_time", "skip_votes", "reset_votes",
+                "host_id", "is_playing", "round_info", "is_clearing", "is_final", "hand")
+
+
+def _votes(ids: list) -> bytes:
+    bits = 0
+    for player_id in ids:
+        bits |= 1 << player_id
+    return _U16.pack(bits)
+
+
+def _ranking(ranking: list) -> bytes:
+    parts = [_U8.pack(len(ranking))]
+    for player in ranking:
+        raw = player["name"].encode()[:255]
+        parts.append(_RANK.pack(player["id"], player["score"], len(raw)))
+        parts.append(raw)
+    return b"".join(parts)
+
+
+def _rounds(round_info: str) -> bytes:
+    current, _, total = round_info.partition("/")
+    return _ROUNDS.pack(int(current), int(total))
+
+
+def _hand(hand: list) -> bytes:
+    # 1 枚: (高さ << 4 | 幅), 行優先のマスのビット (0 なら使用済み)
+    parts = [_U8.pack(len(hand))]
+    for shape in hand:
+        if shape is None:
+            parts.append(_PIECE.pack(0, 0))
+            continue
+        width = len(shape[0])
+        bits = 0
+        for r, row in enumerate(shape):
+            for c, v in enumerate(row):
+                if v:
+                    bits |= 1 << (r * width + c)
+        parts.append(_PIECE.pack(len(shape) << 4 | width, bits))
+    return b"".join(parts)
+
+
+_ENCODERS = {
+    "count": _U8.pack,
+    "ranking": _ranking,
+    "current_turn": _U8.pack,
+    "turn_start_time": _F64.pack,
+    "skip_votes": _votes,
+    "reset_votes": _votes,
+    "host_id": _U8.pack,
+    "is_playing": _U8.pack,
+    "round_info": _rounds,
+    "is_clearing": _U8.pack,
+    "is_final": _U8.pack,
+    "hand": _hand,
+}
+
+
+def _state_fields(message: dict) -> tuple[int, bytes]:
+    present = 0
+    parts = []
+    for bit, name in enumerate(STATE_FIELDS):
+        if name in message:
+            present |= 1 << bit
+            parts.append(_ENCODERS[name](message[name]))
+    return present, b"".join(parts)
+
+
+def _rows_to_mask(rows: list) -> int:
+    mask = 0
+    for r, row in enumerate(rows):
+        for c, v in enumerate(row):
+            if v:
+                mask |= 1 << (r * BOARD_SIZE + c)
+    return mask
+
+
+def encode(message: dict):
+    # バイナリにできるフレームならバイト列を、できなければ None (JSON で送る) を返す
+    # 値が固定長に収まらない時 (極端なスコアなど) も JSON で送る
+    try:
+        return _encode(message)
+    except (struct.error, ValueError, OverflowError):
+        return None
+
+
+def _encode(message: dict):
+    kind = message.get("type")
+    if kind == "batch_update":
+        set_mask, unset_mask = updates_to_masks(message["updates"])
+        return _BOARD.pack(MSG_BOARD, message.get("eseq", 0), set_mask, unset_mask)
+    if kind == "game_state":
+        present, body = _state_fields(message)
+        return _STATE_HEAD.pack(MSG_STATE, message["seq"], int(bool(message.get("full"))), present) + body
+    if kind == "spectate":
+        present, body = _state_fields(message)
+        return _SPECTATE_HEAD.pack(MSG_SPECTATE, _rows_to_mask(message["board"]), present) + body
+    return None
+
+
+def decode(data: bytes):
+    # クライアントからのバイナリをメッセージにする。知らない形式なら None
+    if len(data) == _PLACE.size and data[0] == MSG_PLACE:
+        _, mask = _PLACE.unpack(data)
+        return {"type": "batch_update", "mask": mask}
+    return None